@@ -2,13 +2,27 @@
 
 import streamlit as st
 import pandas as pd
+import html
 from datetime import datetime
 import gspread
 from PIL import Image
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional, Set
 from dataclasses import dataclass
 import time
 
+from storage import (ExcelRepository, GoogleSheetsRepository, MirroredRepository, Repository,
+                     SQLiteRepository, StaleBookingError, WriteBehindRepository)
+from snapshot import BackendUnavailableError, Snapshot, SnapshotDiskCache, SnapshotStore
+from indexes import PORTAFOGLI_ATTR, AvailabilityIndex, BookingIndex, BookingKey, DuplicateBookingError, PortfolioIndex, SearchIndex
+from schema import BOOL_COLUMNS, PRENOTAZIONI_COLUMNS, SchemaError, describe_schema, normalize_prenotazioni
+from metrics import METRICS, timed
+from lazy_database import MAX_PORTAFOGLI
+from archive import ARCHIVE_BATCH_SIZE, ARCHIVE_INTERVAL_SECONDS, ArchiveJob
+from quota import QuotaClient, QuotaLimiter, READS_PER_MINUTE, WRITES_PER_MINUTE
+from bulk import IMPORT_COLUMNS, build_prenotazioni, read_upload, validate_bookings
+from offline import OfflineQueue
+from warmup import WarmUp
+
 st.set_page_config(
                     page_title="FBS - Richieste Fascicoli",
                     page_icon=Image.open("img/FBS.jpg"),
@@ -26,17 +40,22 @@ st.markdown("""
 
 @dataclass
 class Config:
-    REQUIRED_COLUMNS = [
-                        'PORTAFOGLIO', 'NDG', 'DATA_RICHIESTA','PRENOTATO', 'RESTITUITO', 'DATA_EVASIONE', 'DATA_RESTITUZIONE',
-                        'GESTORE','MOTIVAZIONE_RICHIESTA','NOTE', 'MOTIVO_SINGOLO_DOC','INDIC_DOC_SCANSIONARE','DETTAGLIO_RICHIESTA_INTERO',
-                        ]
+    REQUIRED_COLUMNS = PRENOTAZIONI_COLUMNS
     MOTIVAZIONI = [
                     "Scansione intero fascicolo (solo se completamente assente o privo di documentazione rilevante)",
                     #"Richiesta fascicolo cartaceo per scansione singolo documento  (compilare campo dettaglio scansione) solo per escussione garanzia consortile, richiesta specifica debitori, reclami",
                     "Richiesta fascicolo CARTACEO",
                     ]
     
-    BOOL_COLUMNS = ['PRENOTATO', 'RESTITUITO']
+    BOOL_COLUMNS = BOOL_COLUMNS
+
+    # Risultati di ricerca: righe per pagina e numero massimo di righe consultabili
+    RESULTS_PAGE_SIZE = 20
+    RESULTS_MAX_ROWS = 500
+
+    # Ruoli (user_state['role']) abilitati al back-office dell'archivio
+    BACKOFFICE_ROLES = ["admin", "archivio"]
+    BACKOFFICE_MAX_ROWS = 1000
 
     #UNICA
     MOTIVAZIONE_SCANSIONE_SINGOLO_DOC = ["Escussione garanzia consortile",
@@ -60,24 +79,35 @@ class Config:
     DETTAGLIO_RICHIESTA_INTERO_FASCICOLO_CARTACEO = ["Azionare il credito ( necessario titolo / doc in originale )",
                                                         ]
 
-def render_search_filters(df: pd.DataFrame) -> Tuple[str, str, str, pd.DataFrame]:
+def render_search_filters(index: PortfolioIndex, search_index: SearchIndex,
+                          database: pd.DataFrame) -> Tuple[str, str, str]:
     st.sidebar.header("Filtri di Ricerca")
     
-    portafogli_list = sorted(df['PORTAFOGLIO'].unique())
+    # Le opzioni arrivano già ordinate dall'indice dello snapshot
     portafoglio = st.sidebar.selectbox(
                                         "Seleziona Portafoglio *",
-                                        options=[''] + portafogli_list,
+                                        options=index.portafoglio_options,
                                         index=0
                                         )
     if not portafoglio:
         st.sidebar.markdown('<p class="required">⚠️ La selezione del Portafoglio è obbligatoria</p>', 
                           unsafe_allow_html=True)
+    elif ensure_portafogli([portafoglio]):
+        # Portafoglio appena caricato: si riparte con lo snapshot che lo contiene
+        st.rerun()
     
-    ndg_list = sorted(df['NDG'].unique().astype(str)) if not portafoglio else \
-               sorted(df[df['PORTAFOGLIO'] == portafoglio]['NDG'].unique().astype(str))
+    # Ricerca type-ahead: alla UI arrivano solo i primi risultati, non tutti gli NDG
+    query = st.sidebar.text_input("Cerca NDG, nominativo, scatola o creditline",
+                                  key="search_query")
+    hits = database.iloc[search_index.search(query, portafoglio)]
+    names = hits['NOMINATIVO'].astype(str) if 'NOMINATIVO' in hits.columns else ''
+    labels = dict(zip(hits['NDG'], hits['NDG'] + " - " + names))
+    if query and not labels:
+        st.sidebar.caption("Nessun fascicolo corrisponde alla ricerca")
     ndg = st.sidebar.selectbox(
                                 "Seleziona NDG *",
-                                options=[''] + ndg_list,
+                                options=[''] + list(labels),
+                                format_func=lambda value: labels.get(value, value),
                                 index=0
                                 )
     if not ndg:
@@ -116,10 +146,12 @@ def render_booking_form(gestori: pd.DataFrame) -> str:
 
 # --- FUNZIONE DI AUTENTICAZIONE OTTIMIZZATA ---
 @st.cache_resource
-def get_gspread_client() -> gspread.Client:
+def get_gspread_client() -> QuotaClient:
     """
     Si connette a Google Sheets usando le credenziali di Streamlit Secrets
-    e mette in cache la connessione per riutilizzarla.
+    e mette in cache la connessione per riutilizzarla. Tutte le richieste
+    passano da un unico QuotaLimiter per processo (quote per minuto
+    `sheets_reads_per_minute` / `sheets_writes_per_minute` nei secrets).
     """
     try:
         credentials = {
@@ -134,123 +166,488 @@ def get_gspread_client() -> gspread.Client:
             "auth_provider_x509_cert_url": st.secrets["auth_provider_x509_cert_url"],
             "client_x509_cert_url": st.secrets["client_x509_cert_url"]
         }
-        return gspread.service_account_from_dict(credentials)
+        with METRICS.time("gspread_client"):
+            client = gspread.service_account_from_dict(credentials)
+        limiter = QuotaLimiter(
+            reads_per_minute=float(st.secrets.get("sheets_reads_per_minute", READS_PER_MINUTE)),
+            writes_per_minute=float(st.secrets.get("sheets_writes_per_minute", WRITES_PER_MINUTE)),
+        )
+        return QuotaClient(client, limiter)
     except Exception as e:
         st.error(f"Errore durante l'autenticazione a Google Sheets: {e}")
         raise
 
 
+# --- SORGENTE DATI ---
+@st.cache_resource
+def get_repository() -> Repository:
+    """
+    Backend dati, scelto con `storage_backend` nei secrets:
+    - "gsheets" (default): Google Sheets, lettura incrementale; con `lazy_database`
+      il foglio database si carica per portafoglio, al primo utilizzo, tenendone
+      in memoria al più `lazy_max_portafogli`;
+    - "excel": file locale `excel_path` (obbligatorio, nessun default: il dati/db_fascicoli.xlsx
+      del repository ha lo schema precedente), nessuna connessione; fogli e colonne richiesti
+      sono in schema.SHEET_COLUMNS (verificati a ogni caricamento, vedi README);
+    - "sqlite": SQLite locale `sqlite_path` come archivio primario, Google Sheets come mirror asincrono.
+    Le scritture su Google Sheets passano da una coda in background con journal
+    locale `journal_path`.
+    """
+    backend = st.secrets.get("storage_backend", "gsheets")
+    if backend == "excel":
+        excel_path = st.secrets.get("excel_path")
+        if not excel_path:
+            raise SchemaError(f"storage_backend = \"excel\" richiede excel_path, un file .xlsx con i fogli "
+                              f"e le colonne {describe_schema()}")
+        return ExcelRepository(excel_path, normalize=normalize_prenotazioni)
+
+    gc = get_gspread_client()
+    with METRICS.time("open_by_key"):
+        sh = gc.open_by_key(st.secrets["gsheet_id"])
+    # Il caricamento pigro non si applica al mirror: SQLite conserva tutto il database
+    lazy = backend == "gsheets" and bool(st.secrets.get("lazy_database", False))
+    sheets_repo = WriteBehindRepository(
+        GoogleSheetsRepository(sh, normalize=normalize_prenotazioni, lazy_database=lazy,
+                               max_portafogli=int(st.secrets.get("lazy_max_portafogli", MAX_PORTAFOGLI))),
+        journal_path=st.secrets.get("journal_path", "dati/prenotazioni_in_attesa.jsonl"),
+    )
+    if backend == "sqlite":
+        primary = SQLiteRepository(st.secrets.get("sqlite_path", "dati/fascicoli.sqlite"),
+                                   normalize=normalize_prenotazioni)
+        return MirroredRepository(primary, sheets_repo)
+    return sheets_repo
+
+
+# --- SNAPSHOT CONDIVISO TRA LE SESSIONI ---
+@st.cache_resource
+def get_snapshot_store() -> SnapshotStore:
+    """
+    Store unico per processo: il refresh (single-flight) legge dal Repository,
+    che per Google Sheets scarica solo le righe aggiunte.
+    All'avvio riparte dalla copia Parquet in `snapshot_cache_dir` (se presente):
+    il Repository viene creato solo al primo refresh, in background.
+    Se il backend non risponde lo store serve l'ultimo snapshot in sola lettura
+    e, alla ripresa, reinvia le prenotazioni della coda locale.
+    """
+    disk_cache = SnapshotDiskCache(st.secrets.get("snapshot_cache_dir", "dati/cache"))
+    return SnapshotStore(lambda: get_repository().load(), disk_cache=disk_cache, on_recover=replay_offline)
+
+
+# --- MODALITÀ DEGRADATA: CODA LOCALE DELLE PRENOTAZIONI ---
+@st.cache_resource
+def get_offline_queue() -> OfflineQueue:
+    """Prenotazioni accettate con il backend non raggiungibile (journal `offline_queue_path`)."""
+    return OfflineQueue(st.secrets.get("offline_queue_path", "dati/prenotazioni_offline.jsonl"))
+
+
+def replay_offline():
+    """
+    Reinvia in background la coda locale con il percorso di scrittura normale
+    (store.book + append_prenotazioni_if_absent). Se il backend non risponde
+    ancora, lo store torna in modalità degradata e riprova alla ripresa.
+    """
+    store = get_snapshot_store()
+
+    def book(rows: List[List[str]]):
+        new_df = normalize_prenotazioni(pd.DataFrame(rows, columns=Config.REQUIRED_COLUMNS))
+        keys = set(BookingIndex.build(new_df).keys)
+        store.book(new_df, write=lambda: get_repository().append_prenotazioni_if_absent(rows, keys))
+
+    get_offline_queue().replay_in_background(book, on_error=store.mark_degraded)
+
+
+def write_prenotazioni(rows: List[List[str]], keys: Set[BookingKey]):
+    """
+    Scrittura delle nuove prenotazioni per store.book: compare-and-append sul
+    backend o, se non è raggiungibile, accodamento locale (poi replay_offline).
+    """
+    store = get_snapshot_store()
+    if not store.degraded:
+        try:
+            repository = get_repository()
+            repository.append_prenotazioni_if_absent(rows, keys)
+            if repository.write_status() is not None:
+                # In coda di invio: l'esito definitivo arriva dopo (render_prenotazioni_scartate)
+                st.session_state.in_coda.extend(rows)
+            return
+        except DuplicateBookingError:
+            raise
+        except Exception as e:
+            store.mark_degraded(e)
+    get_offline_queue().add(rows)
+    st.session_state.in_coda.extend(rows)
+
+
+# --- ARCHIVIAZIONE DELLE PRENOTAZIONI RESTITUITE ---
+@st.cache_resource
+def get_archive_job() -> Optional[ArchiveJob]:
+    """
+    Job di archiviazione, attivo solo se `archive_after_days` è nei secrets e
+    solo nell'istanza designata con `archive_runner = true` (una sola per
+    spreadsheet: il job cancella righe per posizione): sposta nel foglio
+    archivio_prenotazioni le prenotazioni restituite da più di quei giorni,
+    ogni `archive_interval_hours` ore.
+    """
+    after_days = st.secrets.get("archive_after_days")
+    if not after_days or not st.secrets.get("archive_runner", False):
+        return None
+    interval = float(st.secrets.get("archive_interval_hours", ARCHIVE_INTERVAL_SECONDS / 3600)) * 3600
+    return ArchiveJob(get_repository(), get_snapshot_store(), after_days=int(after_days),
+                      batch_size=int(st.secrets.get("archive_batch_size", ARCHIVE_BATCH_SIZE)),
+                      interval=interval)
+
+
+# --- RISCALDAMENTO ALL'AVVIO ---
+@st.cache_resource
+def get_warmup() -> WarmUp:
+    """
+    Avviato dalla prima esecuzione dello script nel processo, già dalla pagina di
+    login: autenticazione, apertura del foglio, primo caricamento con normalizzazione
+    e indici, job di archiviazione. Se lo snapshot è già stato ripristinato dal disco
+    `get()` non scarica nulla; le sessioni che caricano i dati prima della fine
+    condividono il caricamento in corso (refresh single-flight).
+    """
+    steps = []
+    if st.secrets.get("storage_backend", "gsheets") != "excel":
+        steps.append(("gspread_client", get_gspread_client))
+    steps += [
+        ("repository", get_repository),
+        ("snapshot", lambda: get_snapshot_store().get()),
+        ("archive_job", get_archive_job),
+    ]
+    return WarmUp(steps)
+
+
+# --- METRICHE ---
+@st.cache_resource
+def get_metrics_server():
+    """
+    Endpoint Prometheus opzionale (http://127.0.0.1:<metrics_port>/metrics),
+    avviato una sola volta per processo se `metrics_port` è nei secrets.
+    """
+    port = st.secrets.get("metrics_port")
+    if not port:
+        return None
+    return METRICS.serve(int(port))
+
+
+def render_metrics():
+    summary = METRICS.summary()
+    if not summary:
+        return
+    st.write("Tempi per fase (ms, processo):")
+    st.dataframe(pd.DataFrame.from_dict(summary, orient="index").round(1))
+    for name, values in METRICS.gauges().items():
+        st.write(f"{name}: " + ", ".join(f"{label}={value:.0f}" for label, value in values.items()))
+    if st.button("Esporta metriche"):
+        path = st.secrets.get("metrics_path", "dati/metrics.prom")
+        METRICS.export(path)
+        st.write(f"Metriche scritte in {path}")
+
+
 # --- FUNZIONE PER CARICARE I DATI ---
-@st.cache_data(ttl=60)
-def load_google_sheets_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def load_google_sheets_data(force: bool = False) -> Snapshot:
     """
-    Carica i dati dai fogli Google specificati in DataFrame Pandas.
-    Usa la cache di Streamlit per evitare ricaricamenti frequenti.
+    Restituisce lo snapshot condiviso dei fogli Google, almeno alla versione
+    richiesta da questa sessione (es. dopo una sua prenotazione).
+    Con force=True rilegge i fogli, senza invalidare le altre sessioni.
     """
     try:
-        gc = get_gspread_client()
-        sh = gc.open_by_key(st.secrets["gsheet_id"])
-        
-        worksheets = {
-            "database": sh.worksheet("database"),
-            "prenotazioni": sh.worksheet("prenotazioni"),
-            "gestori": sh.worksheet("gestori"),
-        }
-        
-        # # RIMUOVI TUTTI I FILTRI PRIMA DI LEGGERE
-        # for name, ws in worksheets.items():
-        #     force_remove_all_filters(ws)
-        
-        dfs = {name: pd.DataFrame(ws.get_all_records()) for name, ws in worksheets.items()}
-        
-        # Usa la configurazione dalla classe Config
-        for col in Config.BOOL_COLUMNS:
-            if col in dfs['prenotazioni'].columns:
-                dfs['prenotazioni'][col] = dfs['prenotazioni'][col].astype(str).str.upper().map({'TRUE': True, 'FALSE': False, '': False}).fillna(False)
-        
-        # CORREZIONE DATE: Converti le date con dayfirst=True per formato DD/MM/YYYY
-        date_columns = ['DATA_RICHIESTA', 'DATA_EVASIONE', 'DATA_RESTITUZIONE']
-        for col in date_columns:
-            if col in dfs['prenotazioni'].columns:
-                dfs['prenotazioni'][col] = pd.to_datetime(
-                    dfs['prenotazioni'][col], 
-                    format='%d/%m/%Y', 
-                    dayfirst=True,  # IMPORTANTE: forza il formato giorno/mese/anno
-                    errors='coerce'
-                )
-        
-        return dfs['database'], dfs['prenotazioni'], dfs['gestori']
+        store = get_snapshot_store()
+        if force:
+            snap = store.refresh()
+        else:
+            snap = store.get(min_version=st.session_state.get('min_data_version', 0))
+        st.session_state.min_data_version = snap.version
+        return snap
     
+    except BackendUnavailableError as e:
+        retry_in = max(0, e.retry_at - time.time())
+        st.error(f"Dati non disponibili: Google Sheets non raggiungibile e nessuna copia locale ({e.error}). "
+                 f"Nuovo tentativo automatico tra {retry_in:.0f}s.")
+        raise
+    except SchemaError as e:
+        st.error(f"Impossibile caricare i dati: {e}")
+        raise
     except Exception as e:
         st.error(f"Errore durante il caricamento dei dati da Google Sheets: {e}")
         raise
 
 
-# --- FUNZIONE PER SALVARE UNA NUOVA PRENOTAZIONE ---
-def save_prenotazione(prenotazioni: pd.DataFrame, new_prenotazione: Dict) -> pd.DataFrame:
+def ensure_portafogli(portafogli) -> bool:
     """
-    Salva una nuova riga di prenotazione nel foglio Google e aggiorna il DataFrame locale.
-    Usa get_all_values() per calcolare l'ultima riga effettiva, ignorando i filtri.
+    Caricamento pigro del database: scarica i portafogli non ancora in memoria
+    e pubblica lo snapshot che li contiene. True se lo snapshot è cambiato.
+    In modalità degradata si usano solo i portafogli già in memoria.
     """
-    try:
-        gc = get_gspread_client()
-        sh = gc.open_by_key(st.secrets["gsheet_id"])
-        prenotazioni_w = sh.worksheet("prenotazioni")
-
-        # # RIMUOVI TUTTI I FILTRI PRIMA DI SALVARE
-        # force_remove_all_filters(prenotazioni_w)
-
-        # --- METODO ALTERNATIVO: CALCOLA L'ULTIMA RIGA CON get_all_values() ---
-        # Questo metodo legge TUTTI i dati reali del foglio, ignorando completamente i filtri
-        all_values = prenotazioni_w.get_all_values()
-        next_row = len(all_values) + 1  # La prossima riga disponibile
+    if get_snapshot_store().degraded or not get_repository().load_portafogli(portafogli):
+        return False
+    st.session_state.min_data_version = get_snapshot_store().refresh().version
+    return True
+
+
+def format_prenotazione(new_prenotazione: Dict) -> Dict:
+    """Prepara una prenotazione per la scrittura: data in formato gg/mm/aaaa e booleani TRUE/FALSE."""
+    new_prenotazione = dict(new_prenotazione)
+    if 'DATA_RICHIESTA' in new_prenotazione and new_prenotazione['DATA_RICHIESTA']:
+        if not isinstance(new_prenotazione['DATA_RICHIESTA'], (datetime, pd.Timestamp)):
+            # CORREZIONE DATE: Se è una stringa, prova a parsarla con dayfirst=True
+            try:
+                new_prenotazione['DATA_RICHIESTA'] = pd.to_datetime(new_prenotazione['DATA_RICHIESTA'], dayfirst=True)
+            except:
+                new_prenotazione['DATA_RICHIESTA'] = pd.to_datetime(new_prenotazione['DATA_RICHIESTA'])
         
-        # Preparazione dei dati per la scrittura
-        if 'DATA_RICHIESTA' in new_prenotazione and new_prenotazione['DATA_RICHIESTA']:
-            if not isinstance(new_prenotazione['DATA_RICHIESTA'], (datetime, pd.Timestamp)):
-                # CORREZIONE DATE: Se è una stringa, prova a parsarla con dayfirst=True
-                try:
-                    new_prenotazione['DATA_RICHIESTA'] = pd.to_datetime(new_prenotazione['DATA_RICHIESTA'], dayfirst=True)
-                except:
-                    new_prenotazione['DATA_RICHIESTA'] = pd.to_datetime(new_prenotazione['DATA_RICHIESTA'])
-            
-            new_prenotazione['DATA_RICHIESTA'] = new_prenotazione['DATA_RICHIESTA'].strftime('%d/%m/%Y')
+        new_prenotazione['DATA_RICHIESTA'] = new_prenotazione['DATA_RICHIESTA'].strftime('%d/%m/%Y')
 
-        # Usa la configurazione dalla classe Config per le colonne booleane
-        for key in Config.BOOL_COLUMNS:
-            if key in new_prenotazione:
-                new_prenotazione[key] = str(new_prenotazione[key]).upper()
+    # Usa la configurazione dalla classe Config per le colonne booleane
+    for key in Config.BOOL_COLUMNS:
+        if key in new_prenotazione:
+            new_prenotazione[key] = str(new_prenotazione[key]).upper()
+    return new_prenotazione
+
+# --- FUNZIONE PER SALVARE UNA NUOVA PRENOTAZIONE ---
+@timed("save_prenotazione")
+def save_prenotazione(new_prenotazione: Dict) -> Optional[pd.DataFrame]:
+    """
+    Salva una nuova riga di prenotazione nel backend con un solo append (per Google
+    Sheets una sola chiamata API, indipendente dalla dimensione del foglio) e aggiorna
+    lo snapshot in memoria senza invalidarlo.
+    Controllo duplicati e scrittura sono atomici (lock per chiave + compare-and-append
+    sul backend): se la chiave risulta già prenotata restituisce None.
+    """
+    try:
+        new_prenotazione = format_prenotazione(new_prenotazione)
 
         # Usa la configurazione dalla classe Config per l'ordine delle colonne
         new_row_data = [str(new_prenotazione.get(col, '')) for col in Config.REQUIRED_COLUMNS]
         
-        # Inserisce direttamente nella riga calcolata usando update() invece di append_row()
-        end_col = chr(ord('A') + len(Config.REQUIRED_COLUMNS) - 1)
-        range_name = f"A{next_row}:{end_col}{next_row}"
-        prenotazioni_w.update(range_name, [new_row_data], value_input_option="USER_ENTERED")
-
-        # Aggiorna il DataFrame locale per riflettere immediatamente la modifica nell'UI
-        new_df = pd.DataFrame([new_prenotazione])
-        updated_prenotazioni = pd.concat([prenotazioni, new_df], ignore_index=True)
+        new_df = normalize_prenotazioni(pd.DataFrame([new_prenotazione]))
+        keys = set(BookingIndex.build(new_df).keys)
         
-        # CORREZIONE DATE: Usa dayfirst=True anche nel parsing locale
-        updated_prenotazioni['DATA_RICHIESTA'] = pd.to_datetime(
-            updated_prenotazioni['DATA_RICHIESTA'], 
-            format='%d/%m/%Y', 
-            dayfirst=True,  # IMPORTANTE: forza il formato giorno/mese/anno
-            errors='coerce'
-        )
-        updated_prenotazioni = updated_prenotazioni.sort_values(by='DATA_RICHIESTA', ascending=True, ignore_index=True)
+        # Append locale (Excel/SQLite) o accodato per l'invio a Google Sheets; lo snapshot
+        # condiviso viene aggiornato subito per riflettere la modifica nell'UI
+        try:
+            snap = get_snapshot_store().book(new_df, write=lambda: write_prenotazioni([new_row_data], keys))
+        except DuplicateBookingError:
+            st.warning(f"Esiste già una prenotazione attiva per questo NDG/Portafoglio con la motivazione: "
+                       f"{new_prenotazione.get('MOTIVAZIONE_RICHIESTA')}")
+            return None
         
+        # La sessione che ha prenotato deve vedere la propria scrittura
+        st.session_state.min_data_version = snap.version
         st.success("Prenotazione salvata con successo!")
-        load_google_sheets_data.clear()
         
-        return updated_prenotazioni
+        return snap.prenotazioni
         
     except Exception as e:
         st.error(f"Errore critico durante il salvataggio della prenotazione: {e}")
         raise
 
+# --- CARRELLO: PIÙ PRENOTAZIONI CON UNA SOLA SCRITTURA ---
+@timed("save_carrello")
+def save_carrello(carrello: List[Dict]) -> bool:
+    """
+    Salva tutte le prenotazioni del carrello con un solo controllo duplicati e
+    un solo append sul backend (per Google Sheets una sola append_rows).
+    Se alcune chiavi risultano già prenotate non scrive nulla: le toglie dal
+    carrello e restituisce False, così il resto può essere confermato di nuovo.
+    """
+    records = [format_prenotazione(item) for item in carrello]
+    rows = [[str(record.get(col, '')) for col in Config.REQUIRED_COLUMNS] for record in records]
+    new_df = normalize_prenotazioni(pd.DataFrame(records))
+    keys = set(BookingIndex.build(new_df).keys)
+    try:
+        snap = get_snapshot_store().book(new_df, write=lambda: write_prenotazioni(rows, keys))
+    except DuplicateBookingError as e:
+        conflicts = set(e.keys)
+        st.session_state.carrello = [item for item in carrello if cart_key(item) not in conflicts]
+        elenco = ", ".join(f"{ndg}/{portafoglio}" for ndg, portafoglio, _ in e.keys)
+        st.warning(f"Prenotazioni attive già presenti, rimosse dal carrello: {elenco}. "
+                   "Nessuna prenotazione è stata salvata: confermare di nuovo il carrello.")
+        return False
+    st.session_state.min_data_version = snap.version
+    st.session_state.carrello = []
+    return True
+
+def cart_key(item: Dict) -> BookingKey:
+    return BookingIndex.make_key(item['NDG'], item['PORTAFOGLIO'], item['MOTIVAZIONE_RICHIESTA'])
+
+def render_cart():
+    carrello = st.session_state.carrello
+    if not carrello:
+        return
+    st.sidebar.markdown("---")
+    st.sidebar.subheader(f"Carrello ({len(carrello)})")
+    for i, item in enumerate(carrello):
+        cols = st.sidebar.columns([4, 1])
+        cols[0].markdown(f"**{html.escape(str(item['NDG']))}** / {html.escape(str(item['PORTAFOGLIO']))}  \n"
+                         f"{html.escape(str(item['MOTIVAZIONE_RICHIESTA']))}")
+        if cols[1].button("✕", key=f"cart_remove_{i}"):
+            del carrello[i]
+            st.rerun()
+    cols = st.sidebar.columns(2)
+    if cols[0].button(f"Prenota carrello ({len(carrello)})", type="primary"):
+        n = len(carrello)
+        if save_carrello(carrello):
+            st.success(f"{n} fascicoli prenotati con successo!")
+            st.session_state.search_clicked = False
+            st.rerun()
+    if cols[1].button("Svuota carrello"):
+        st.session_state.carrello = []
+        st.rerun()
+
+# --- FUNZIONE PER AGGIORNARE PRENOTAZIONI ESISTENTI ---
+@timed("save_aggiornamenti")
+def save_aggiornamenti(changes: Dict[int, Dict[str, str]], keys: Dict[int, BookingKey]) -> bool:
+    """
+    Applica evasioni/restituzioni (posizione della riga -> nuovi valori) con una
+    sola scrittura sul backend (per Google Sheets una batch_update) e aggiorna
+    lo snapshot in memoria senza ricaricarlo. False se una riga non corrisponde
+    più alla prenotazione selezionata.
+    """
+    updates = [(position, keys[position], values) for position, values in changes.items()]
+    try:
+        snap = get_snapshot_store().update_prenotazioni(
+            changes,
+            write=lambda: get_repository().update_prenotazioni(updates),
+        )
+    except StaleBookingError as e:
+        st.error(f"Aggiornamento annullato: {e}. Ricaricare i dati e riprovare.")
+        return False
+    st.session_state.min_data_version = snap.version
+    return True
+
+# --- FUNZIONE PER L'IMPORT MASSIVO DI PRENOTAZIONI ---
+@timed("save_import")
+def save_import(rows: pd.DataFrame) -> Optional[Snapshot]:
+    """
+    Scrive tutte le prenotazioni importate con un solo append. Se nel frattempo
+    un'altra sessione ha prenotato una delle chiavi, il lotto viene scartato per
+    intero (nessuna scrittura parziale) e restituisce None.
+    """
+    new_df = normalize_prenotazioni(rows.reset_index(drop=True))
+    keys = set(BookingIndex.build(new_df).keys)
+    values = rows.values.tolist()
+    try:
+        snap = get_snapshot_store().book(new_df, write=lambda: write_prenotazioni(values, keys))
+    except DuplicateBookingError:
+        st.warning("Alcuni fascicoli sono stati prenotati nel frattempo da un'altra sessione: "
+                   "nessuna riga è stata scritta. Ricaricare il file per rivalidarlo.")
+        return None
+    st.session_state.min_data_version = snap.version
+    return snap
+
+def render_import(snap: Snapshot):
+    st.title("Importa prenotazioni")
+    st.markdown(f"File CSV o Excel con le colonne {', '.join(IMPORT_COLUMNS)} (NOTE facoltativa).")
+
+    upload = st.file_uploader("File prenotazioni", type=["csv", "xlsx"], key="import_file")
+    gestore = render_booking_form(snap.gestori)
+    if upload is None:
+        return
+
+    try:
+        righe = read_upload(upload.name, upload.getvalue())
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if ensure_portafogli(righe['PORTAFOGLIO'].unique()):
+        snap = load_google_sheets_data()
+    with METRICS.time("validate_import"):
+        accettate, scartate = validate_bookings(righe, snap.database, snap.booking_index, Config.MOTIVAZIONI)
+
+    st.write(f"Righe nel file: {len(righe)} — accettate: {len(accettate)}, scartate: {len(scartate)}")
+    if not scartate.empty:
+        st.markdown("#### Righe scartate")
+        st.dataframe(scartate)
+        st.download_button("Scarica righe scartate", scartate.to_csv(sep=';').encode('utf-8'),
+                           file_name="righe_scartate.csv", mime="text/csv")
+
+    if st.button(f"Prenota {len(accettate)} fascicoli", disabled=accettate.empty or not gestore):
+        rows = build_prenotazioni(accettate, gestore, datetime.now().strftime('%d/%m/%Y'))
+        if save_import(rows) is not None:
+            st.success(f"{len(rows)} prenotazioni salvate con successo!")
+
+def render_backoffice(snap: Snapshot):
+    st.title("Back-office Archivio")
+    active = snap.booking_index.active
+    # Evasioni, restituzioni e archivio richiedono il backend
+    sola_lettura = get_snapshot_store().degraded
+
+    cols = st.columns(2)
+    with cols[0]:
+        portafoglio = st.selectbox("Portafoglio", options=snap.portfolio_index.portafoglio_options,
+                                   key="bo_portafoglio")
+    with cols[1]:
+        stato = st.radio("Prenotazioni attive", ["Da evadere", "Evase, da restituire", "Tutte"],
+                         horizontal=True, key="bo_stato")
+
+    mask = pd.Series(True, index=active.index)
+    if portafoglio:
+        mask &= active['PORTAFOGLIO'] == portafoglio
+    if stato == "Da evadere":
+        mask &= active['DATA_EVASIONE'].isna()
+    elif stato == "Evase, da restituire":
+        mask &= active['DATA_EVASIONE'].notna()
+    columns = ['PORTAFOGLIO', 'NDG', 'DATA_RICHIESTA', 'DATA_EVASIONE', 'GESTORE', 'MOTIVAZIONE_RICHIESTA', 'NOTE']
+    view = active.loc[mask, [c for c in columns if c in active.columns]].head(Config.BACKOFFICE_MAX_ROWS)
+    caption = f"{int(mask.sum())} prenotazioni"
+    if len(view) < mask.sum():
+        caption += f", mostrate le prime {len(view)}: filtrare per portafoglio"
+    st.caption(caption)
+
+    event = st.dataframe(view, on_select="rerun", selection_mode="multi-row", hide_index=True,
+                         key="bo_table")
+    selected = view.index[event.selection.rows]
+
+    oggi = datetime.now().strftime('%d/%m/%Y')
+    changes = {}
+    cols = st.columns(2)
+    with cols[0]:
+        if st.button(f"Segna come evase ({len(selected)})", disabled=selected.empty or sola_lettura):
+            changes = {position: {'DATA_EVASIONE': oggi} for position in selected}
+    with cols[1]:
+        if st.button(f"Segna come restituite ({len(selected)})", disabled=selected.empty or sola_lettura):
+            for position in selected:
+                changes[position] = {'RESTITUITO': 'TRUE', 'DATA_RESTITUZIONE': oggi}
+                if pd.isna(active.at[position, 'DATA_EVASIONE']):
+                    changes[position]['DATA_EVASIONE'] = oggi
+
+    if changes:
+        keys = {position: BookingIndex.make_key(active.at[position, 'NDG'], active.at[position, 'PORTAFOGLIO'],
+                                                active.at[position, 'MOTIVAZIONE_RICHIESTA'])
+                for position in changes}
+        if save_aggiornamenti(changes, keys):
+            st.success(f"{len(changes)} prenotazioni aggiornate")
+            st.rerun()
+
+    if not sola_lettura:
+        render_archivio()
+
+def render_archivio():
+    with st.expander("Storico archiviato", expanded=False):
+        job = get_archive_job()
+        if job is not None:
+            status = job.status
+            if status.last_run:
+                st.caption(f"Ultima archiviazione: {datetime.fromtimestamp(status.last_run):%d/%m/%Y %H:%M}, "
+                           f"{status.last_archived} prenotazioni spostate")
+            if status.last_error is not None:
+                st.caption(f"Errore dell'ultima archiviazione: {status.last_error}")
+            if st.button(f"Archivia ora (restituite da più di {job.after_days} giorni)"):
+                try:
+                    st.success(f"{job.run_once()} prenotazioni archiviate")
+                except Exception as e:
+                    st.error(f"Archiviazione interrotta: {e}")
+
+        ndg = st.text_input("NDG", key="archivio_ndg")
+        if st.button("Cerca nello storico", disabled=not ndg):
+            archivio = get_repository().read_archivio()
+            if archivio.empty:
+                st.info("Nessuna prenotazione archiviata")
+                return
+            st.dataframe(archivio[archivio['NDG'].astype(str) == ndg.strip()], hide_index=True)
+
 def render_login_page():
     st.title('Login Richieste Fascicoli')
     try:
@@ -261,6 +658,8 @@ def render_login_page():
 
     username = st.text_input('Username')
     password = st.text_input('Password', type='password')
+    if get_snapshot_store().version == 0:
+        st.caption("⏳ Preparazione dei dati in corso...")
 
     if st.button('Login', type="primary"):
         users = st.secrets["users"]  # Lista di dizionari
@@ -293,107 +692,221 @@ def init_session_state():
                                         }
     if 'search_clicked' not in st.session_state:
         st.session_state.search_clicked = False
-    if 'last_data_load' not in st.session_state:
-        st.session_state.last_data_load = 0
-
-def render_result_card(row: pd.Series):
-    st.markdown(f"""
-        <div style='color: #87CEEB'>
-            <h5>Portafoglio: {row['PORTAFOGLIO']} - NDG: {row['NDG']} - Nominativo: {row['NOMINATIVO']}</h5>
-            <h5>Codice Scatola: {row['SCATOLA']} - CREDITLINE: {row['ID_CREDITLINE_ACERO']} </h5>
-        </div>
-    """, unsafe_allow_html=True)
+    if 'min_data_version' not in st.session_state:
+        st.session_state.min_data_version = 0
+    if 'carrello' not in st.session_state:
+        st.session_state.carrello = []
+    if 'in_coda' not in st.session_state:
+        # Righe prenotate da questa sessione e non ancora inviate; scartate all'invio
+        st.session_state.in_coda = []
+        st.session_state.scartate = []
+
+def render_results(risultati: pd.DataFrame, availability: AvailabilityIndex):
+    """
+    Una pagina di risultati in un solo blocco HTML, costruito in modo vettoriale
+    sulle sole righe della pagina: dimensione della risposta e tempo di rendering
+    non dipendono dal numero di risultati (al più RESULTS_MAX_ROWS consultabili).
+    """
+    total = len(risultati)
+    consultabili = min(total, Config.RESULTS_MAX_ROWS)
+    n_pages = max(1, -(-consultabili // Config.RESULTS_PAGE_SIZE))
+    page = 1
+    if n_pages > 1:
+        page = st.number_input("Pagina", min_value=1, max_value=n_pages, step=1, key="results_page")
+    start = (page - 1) * Config.RESULTS_PAGE_SIZE
+    rows = risultati.iloc[start:min(start + Config.RESULTS_PAGE_SIZE, consultabili)]
+
+    def col(name: str) -> pd.Series:
+        return rows[name].astype(str).map(html.escape)
+
+    # Stato dalla vista materializzata dello snapshot: nessun join per rerun
+    stato = pd.Series([
+        "Prenotato (" + ", ".join(sorted(motivazioni)) + ")" if motivazioni else "Disponibile"
+        for motivazioni in map(availability.motivazioni, rows['NDG'], rows['PORTAFOGLIO'])
+    ], index=rows.index, dtype=str).map(html.escape)
+
+    cards = ("<h5>Portafoglio: " + col('PORTAFOGLIO') + " - NDG: " + col('NDG')
+             + " - Nominativo: " + col('NOMINATIVO') + "</h5>"
+             + "<h5>Codice Scatola: " + col('SCATOLA') + " - CREDITLINE: " + col('ID_CREDITLINE_ACERO')
+             + " </h5>"
+             + "<h5>Stato: " + stato + "</h5>")
+    st.markdown(f"<div style='color: #87CEEB'>{cards.str.cat(sep='<hr>')}</div>", unsafe_allow_html=True)
+
+    if n_pages > 1 or total > consultabili:
+        caption = f"Risultati {start + 1}-{start + len(rows)} di {total}"
+        if total > consultabili:
+            caption += f" (consultabili i primi {consultabili}: restringere la ricerca)"
+        st.caption(caption)
+
+def render_backend_status(snap: Snapshot):
+    """Modalità degradata (sola lettura dall'ultimo snapshot) e coda locale delle prenotazioni."""
+    store = get_snapshot_store()
+    queue = get_offline_queue()
+    if store.degraded:
+        retry_in = max(0, store.next_probe_at - time.time())
+        st.warning(f"⚠️ Google Sheets non raggiungibile: dati del {datetime.fromtimestamp(snap.loaded_at):%d/%m/%Y %H:%M} "
+                   f"({snap.age / 60:.0f} min fa), in sola lettura. Le nuove prenotazioni restano in coda locale "
+                   f"e saranno inviate alla ripresa (nuovo tentativo tra {retry_in:.0f}s).")
+        st.sidebar.caption(f"Errore: {store.last_error}")
+    if queue.pending:
+        st.sidebar.warning(f"📥 {queue.pending} prenotazioni in coda locale, in attesa di Google Sheets")
+
+def render_write_status():
+    status = get_repository().write_status()
+    if status is None:
+        return
+    if status.last_error is not None:
+        retry_in = max(0, status.retry_at - time.time())
+        st.sidebar.error(f"⚠️ {status.pending} prenotazioni in attesa di invio a Google Sheets "
+                         f"(nuovo tentativo tra {retry_in:.0f}s): {status.last_error}")
+    elif status.pending:
+        st.sidebar.warning(f"📤 {status.pending} prenotazioni in attesa di invio a Google Sheets")
+    elif status.last_flush:
+        st.sidebar.caption(f"✅ Prenotazioni inviate a Google Sheets alle {datetime.fromtimestamp(status.last_flush):%H:%M:%S}")
+
+def render_prenotazioni_scartate():
+    """
+    Prenotazioni di questa sessione accettate in coda (coda di invio o coda
+    locale) e scartate all'invio perché nel frattempo già prenotate da altri.
+    Si segnalano solo a chi le ha fatte, finché non le conferma lette.
+    """
+    in_coda = st.session_state.in_coda
+    if in_coda:
+        try:
+            scartate, in_attesa = get_repository().queue_outcome(in_coda)
+        except Exception:
+            # Repository non creato (backend non raggiungibile): si riprova al prossimo giro
+            scartate, in_attesa = [], in_coda
+        scartate_locali, in_attesa_locali = get_offline_queue().queue_outcome(in_coda)
+        st.session_state.scartate.extend(scartate + scartate_locali)
+        ancora = {tuple(map(str, row)) for row in in_attesa + in_attesa_locali}
+        st.session_state.in_coda = [row for row in in_coda if tuple(map(str, row)) in ancora]
+    if st.session_state.scartate:
+        elenco = ", ".join(f"{r['NDG']}/{r['PORTAFOGLIO']} ({r['MOTIVAZIONE_RICHIESTA']})"
+                           for r in (dict(zip(Config.REQUIRED_COLUMNS, row)) for row in st.session_state.scartate))
+        st.error(f"Prenotazioni non registrate perché in conflitto con prenotazioni fatte nel frattempo "
+                 f"da altri utenti (un carrello o un import si scarta per intero): {elenco}")
+        if st.button("Ho preso nota", key="chiudi_scartate"):
+            st.session_state.scartate = []
+            st.rerun()
 
 def main():
     init_session_state()
+    get_metrics_server()
+    warmup = get_warmup()
 
     if not st.session_state.user_state['logged_in']:
         render_login_page()
         return
     
-    st.title("Richieste Fascicoli FBS")    
-
-    if st.sidebar.button("🔄 Ricarica Dati"):
-        load_google_sheets_data.clear()
-        st.session_state.last_data_load = time.time()
-        st.rerun()
+    pagine = ["Richieste", "Importa prenotazioni"]
+    if st.session_state.user_state['role'] in Config.BACKOFFICE_ROLES:
+        pagine.append("Back-office")
+    pagina = st.sidebar.radio("Pagina", pagine, key="pagina")
+    if pagina == "Richieste":
+        st.title("Richieste Fascicoli FBS")    
+
+    force_reload = st.sidebar.button("🔄 Ricarica Dati")
     
-    # Force refresh data if it's been more than 10 seconds
-    current_time = time.time()
-    if current_time - st.session_state.last_data_load > 10:
-        load_google_sheets_data.clear()
-        st.session_state.last_data_load = current_time
+    store = get_snapshot_store()
+    if store.version == 0 and not warmup.ready.is_set():
+        # Nessuno snapshot ancora disponibile: si attende il primo caricamento del
+        # riscaldamento, non le fasi successive (job di archiviazione)
+        with st.spinner("Preparazione dei dati in corso..."):
+            while store.version == 0 and not warmup.ready.wait(0.1):
+                pass
     
+    # Lo snapshot condiviso si aggiorna da solo in background ogni REFRESH_SECONDS
     try:
-        database, prenotazioni, gestori = load_google_sheets_data()
+        snap = load_google_sheets_data(force=force_reload)
     except Exception:
         return
+    database, prenotazioni, gestori = snap.database, snap.prenotazioni, snap.gestori
+    if not store.degraded:
+        try:
+            get_archive_job()
+        except Exception as e:
+            # Repository non creato (es. open_by_key fallita): backend non raggiungibile
+            store.mark_degraded(e)
+    if get_offline_queue().pending and not store.degraded:
+        replay_offline()
     
     # Create debug expander to view current data
     with st.sidebar.expander("Debug Info", expanded=False):
-        st.write(f"Data last refreshed: {st.session_state.last_data_load}")
+        st.write(f"Data version: {snap.version}")
+        st.write(f"Data last refreshed: {datetime.fromtimestamp(snap.loaded_at):%H:%M:%S} ({snap.age:.0f}s ago)")
+        if store.last_error is not None:
+            st.write(f"Last refresh error: {store.last_error}")
+        st.write(f"Warm-up: {warmup.duration:.1f}s" + (f", error: {warmup.error}" if warmup.error else ""))
         st.write(f"Total prenotations: {len(prenotazioni)}")
-        st.write(f"Non-returned prenotations: {len(prenotazioni[~prenotazioni['RESTITUITO']])}")
+        st.write(f"Non-returned prenotations: {len(snap.booking_index.active)}")
+        for name, (raw_bytes, typed_bytes) in snap.memory_report.items():
+            st.write(f"Memory {name}: {typed_bytes / 2**20:.1f} MB "
+                     f"(da {raw_bytes / 2**20:.1f} MB, -{1 - typed_bytes / max(raw_bytes, 1):.0%})")
+        render_metrics()
     
-    df = database.copy()
-    df['DISPONIBILE'] = True
+    render_backend_status(snap)
+    if not store.degraded:
+        render_write_status()
+    render_prenotazioni_scartate()
     
-    # Get fresh active prenotations
-    active_prenotations = prenotazioni[~prenotazioni['RESTITUITO']].copy()
+    if pagina == "Richieste":
+        render_cart()
     
-    # Generate check_keys for all active prenotations
-    if not active_prenotations.empty:
-        active_prenotations['check_key'] = active_prenotations.apply(
-            lambda x: f"{str(x['NDG'])}_{str(x['PORTAFOGLIO'])}_{str(x['MOTIVAZIONE_RICHIESTA'])}", 
-            axis=1
-        )
-        
+    if pagina == "Back-office":
+        render_backoffice(snap)
+        return
+    if pagina == "Importa prenotazioni":
+        render_import(snap)
+        return
+    
+    # Active prenotations and their check keys come precomputed with the snapshot
+    if not snap.booking_index.active.empty:
         # Debug check keys
         with st.sidebar.expander("Active Prenotations", expanded=False):
-            st.write(active_prenotations[['NDG', 'PORTAFOGLIO', 'MOTIVAZIONE_RICHIESTA', 'check_key']])
+            st.write(snap.booking_index.active[['NDG', 'PORTAFOGLIO', 'MOTIVAZIONE_RICHIESTA']])
     
-    portafoglio, ndg, motivazione = render_search_filters(df)
+    with METRICS.time("render_filters"):
+        portafoglio, ndg, motivazione = render_search_filters(snap.portfolio_index, snap.search_index,
+                                                              database)
     
     if st.sidebar.button("Cerca"):
         if not ndg:
             st.sidebar.error("Devi selezionare un NDG prima di cercare")
             return
         
-        # Force reload data to ensure we have the latest prenotations
-        load_google_sheets_data.clear()
-        database, prenotazioni, gestori = load_google_sheets_data()
-        active_prenotations = prenotazioni[~prenotazioni['RESTITUITO']].copy()
-        
-        if not active_prenotations.empty:
-            active_prenotations['check_key'] = active_prenotations.apply(
-                lambda x: f"{str(x['NDG'])}_{str(x['PORTAFOGLIO'])}_{str(x['MOTIVAZIONE_RICHIESTA'])}", 
-                axis=1
-            )
+        # Latest prenotations: single-flight refresh, shared with the other sessions
+        snap = load_google_sheets_data(force=True)
+        database, prenotazioni, gestori = snap.database, snap.prenotazioni, snap.gestori
         
         st.session_state.search_clicked = True
+        st.session_state.results_page = 1
     
     if st.session_state.search_clicked and ndg:
-        mask = (df['NDG'].astype(str) == ndg)
+        # NDG è già una colonna stringa nello snapshot (schema.py): nessuna copia né conversione
+        mask = (database['NDG'] == ndg)
         if portafoglio:
-            mask &= (df['PORTAFOGLIO'] == portafoglio)
-        risultati = df[mask]
+            mask &= (database['PORTAFOGLIO'] == portafoglio)
+        if st.sidebar.checkbox("Solo fascicoli disponibili", key="solo_disponibili"):
+            mask &= snap.availability.available
+        risultati = database[mask]
         
         if risultati.empty:
             st.warning("Nessun risultato trovato per i criteri di ricerca specificati")
             return
         
         # Check if a prenotation already exists
-        if motivazione and not active_prenotations.empty:
+        if motivazione:
             check_key = f"{str(ndg)}_{str(portafoglio)}_{str(motivazione)}"
             st.write("Current check key:", check_key)  # Debug line
             
-            if check_key in active_prenotations['check_key'].values:
+            if snap.booking_index.has_active_booking(ndg, portafoglio, motivazione):
                 st.warning(f"Esiste già una prenotazione attiva per questo NDG/Portafoglio con la motivazione: {motivazione}")
                 return
         
-        for _, row in risultati.iterrows():
-            render_result_card(row)
-        gestore = render_booking_form(gestori)
+        with METRICS.time("render_results"):
+            render_results(risultati, snap.availability)
+            gestore = render_booking_form(gestori)
 
         ###################################################################################
 
@@ -428,15 +941,14 @@ def main():
                 notes = st.text_area(xx, key="note")
                 mot_singolo_doc = "FASCICOLO COMPLETO"
 
-        if st.button("Prenota Fascicolo"):
+        cols = st.columns(2)
+        prenota = cols[0].button("Prenota Fascicolo")
+        aggiungi = cols[1].button("Aggiungi al carrello")
+        if prenota or aggiungi:
             if not all([ndg, motivazione, gestore]):
                 st.error("Tutti i campi obbligatori devono essere compilati")
                 return
 
-            # Force data reload before saving to ensure we have latest data
-            load_google_sheets_data.clear()
-            database, prenotazioni, gestori = load_google_sheets_data()
-            
             ndg_riga = risultati.iloc[0]['NDG']
             portafoglio_riga = risultati.iloc[0]['PORTAFOGLIO']
 
@@ -456,7 +968,16 @@ def main():
                                 'NOTE': notes,
                                 }
             
-            save_prenotazione(prenotazioni, new_prenotazione)
+            if aggiungi:
+                if cart_key(new_prenotazione) in {cart_key(item) for item in st.session_state.carrello}:
+                    st.warning("Il fascicolo è già nel carrello con questa motivazione")
+                    return
+                st.session_state.carrello.append(new_prenotazione)
+                st.session_state.search_clicked = False
+                st.rerun()
+
+            if save_prenotazione(new_prenotazione) is None:
+                return
             st.success("Fascicolo prenotato con successo!")
             st.session_state.search_clicked = False
             st.rerun()
@@ -464,9 +985,11 @@ def main():
     st.sidebar.markdown("---")
     st.sidebar.subheader("Informazioni Database")
     st.sidebar.info(f"""
-                    - Portafogli disponibili: {len(df['PORTAFOGLIO'].unique())}
-                    - Totale fascicoli: {len(df)}
+                    - Portafogli disponibili: {len(snap.portfolio_index.portafogli)}
+                    - {"Fascicoli in memoria" if PORTAFOGLI_ATTR in database.attrs else "Totale fascicoli"}: {len(database)}
+                    - Fascicoli disponibili: {snap.availability.n_available}
                     """)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with METRICS.time("page_run"):
+        main()
\ No newline at end of file
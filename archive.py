@@ -0,0 +1,85 @@
+"""
+Archiviazione delle prenotazioni restituite (partizione calda/fredda).
+
+Le prenotazioni restituite da più di `after_days` giorni si spostano a lotti
+nel foglio archivio_prenotazioni del backend (Repository.archive_prenotazioni):
+il foglio prenotazioni, letto e indicizzato a ogni refresh, contiene così
+solo le prenotazioni aperte e quelle chiuse di recente. Lo storico resta
+consultabile con Repository.read_archivio.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+from metrics import METRICS
+from snapshot import SnapshotStore
+from storage import Repository
+
+
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_INTERVAL_SECONDS = 24 * 3600
+
+
+def archive_returned(repository: Repository, store: SnapshotStore, after_days: int = ARCHIVE_AFTER_DAYS,
+                     batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Archivia a lotti di `batch_size` righe (per Google Sheets: un append e una
+    batch_update per lotto) finché ce ne sono, poi ricarica lo snapshot: le
+    posizioni delle righe rimaste sono cambiate. Restituisce le righe spostate.
+    """
+    cutoff = date.today() - timedelta(days=after_days)
+    total = 0
+    with METRICS.time("archive"):
+        while True:
+            archived = repository.archive_prenotazioni(cutoff, batch_size)
+            total += archived
+            if archived < batch_size:
+                break
+    if total:
+        store.refresh()
+    return total
+
+
+@dataclass
+class ArchiveStatus:
+    last_run: float
+    last_archived: int
+    last_error: Optional[Exception]
+
+
+class ArchiveJob:
+    """Esegue archive_returned in un thread di background ogni `interval` secondi."""
+
+    def __init__(self, repository: Repository, store: SnapshotStore, after_days: int = ARCHIVE_AFTER_DAYS,
+                 batch_size: int = ARCHIVE_BATCH_SIZE, interval: float = ARCHIVE_INTERVAL_SECONDS):
+        self.repository = repository
+        self.store = store
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.status = ArchiveStatus(0.0, 0, None)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def run_once(self) -> int:
+        with self._lock:
+            try:
+                archived = archive_returned(self.repository, self.store, self.after_days, self.batch_size)
+            except Exception as e:
+                self.status = ArchiveStatus(time.time(), 0, e)
+                raise
+            self.status = ArchiveStatus(time.time(), archived, None)
+            return archived
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # Errore registrato in status; si riprova al prossimo intervallo
+                pass
+            time.sleep(self.interval)
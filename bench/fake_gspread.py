@@ -0,0 +1,175 @@
+"""
+Finto client gspread in memoria, con latenza configurabile per chiamata.
+
+Riproduce il sottoinsieme dell'API usato dall'app (Client.open_by_key,
+Spreadsheet.worksheet/worksheets/add_worksheet/batch_update/values_batch_get/
+get_lastUpdateTime, Worksheet.get_all_records/
+get_all_values/get/batch_get/update/batch_update/append_row/append_rows) e conta le
+chiamate, così che i benchmark misurino anche il traffico verso l'API.
+"""
+
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from gspread.utils import a1_range_to_grid_range, numericise_all, rowcol_to_a1, to_records
+
+
+class FakeAPI:
+    """Stato condiviso: latenza simulata, contatore delle chiamate e revisione dei dati."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.revision = 0
+        self._lock = threading.Lock()
+
+    def touch(self):
+        """Registra una modifica dei dati (cambia il modifiedTime restituito)."""
+        with self._lock:
+            self.revision += 1
+
+    def call(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+def _split_range(range_name: str):
+    """'prenotazioni'!A5:M -> ('prenotazioni', 'A5:M'); 'gestori' -> ('gestori', None)."""
+    if "!" in range_name:
+        title, a1 = range_name.rsplit("!", 1)
+        return title.strip("'"), a1
+    return range_name.strip("'"), None
+
+
+class FakeWorksheet:
+    def __init__(self, api: FakeAPI, title: str, values: List[List[str]], sheet_id: int = 0):
+        self.api = api
+        self.title = title
+        self.id = sheet_id
+        self.values = values
+        self._lock = threading.Lock()
+
+    def _slice(self, a1: Optional[str]) -> List[List[str]]:
+        with self._lock:
+            if not a1:
+                return [list(row) for row in self.values]
+            grid = a1_range_to_grid_range(a1)
+            rows = self.values[grid.get("startRowIndex", 0):grid.get("endRowIndex")]
+            start_col, end_col = grid.get("startColumnIndex", 0), grid.get("endColumnIndex")
+            return [list(row[start_col:end_col]) for row in rows]
+
+    def get_all_values(self, **kwargs) -> List[List[str]]:
+        self.api.call("get_all_values")
+        return self._slice(None)
+
+    def get_all_records(self, head: int = 1, **kwargs) -> List[Dict]:
+        self.api.call("get_all_records")
+        values = self._slice(None)
+        if not values:
+            return []
+        rows = [numericise_all(row, False, "", False, None) for row in values[head:]]
+        return to_records(values[head - 1], rows)
+
+    def get(self, range_name: Optional[str] = None, pad_values: bool = False, **kwargs) -> List[List[str]]:
+        self.api.call("get")
+        return self._slice(range_name)
+
+    def batch_get(self, ranges: List[str], **kwargs) -> List[List[List[str]]]:
+        self.api.call("batch_get")
+        return [self._slice(r) for r in ranges]
+
+    def update(self, range_name: str, values: List[List[str]], **kwargs):
+        self.api.call("update")
+        self._write(range_name, values)
+
+    def batch_update(self, data: List[Dict], **kwargs):
+        self.api.call("batch_update")
+        for entry in data:
+            self._write(entry["range"], entry["values"])
+
+    def _write(self, range_name: str, values: List[List[str]]):
+        grid = a1_range_to_grid_range(range_name)
+        row0, col0 = grid.get("startRowIndex", 0), grid.get("startColumnIndex", 0)
+        with self._lock:
+            for i, row in enumerate(values):
+                while len(self.values) <= row0 + i:
+                    self.values.append([])
+                target = self.values[row0 + i]
+                target.extend([''] * (col0 + len(row) - len(target)))
+                target[col0:col0 + len(row)] = [str(v) for v in row]
+        self.api.touch()
+
+    def append_row(self, values: List[str], **kwargs):
+        self.append_rows([values], **kwargs)
+
+    def append_rows(self, values: List[List[str]], **kwargs):
+        self.api.call("append_rows")
+        with self._lock:
+            start = len(self.values) + 1
+            self.values.extend([str(v) for v in row] for row in values)
+        self.api.touch()
+        # Come la risposta di spreadsheets.values.append
+        end = rowcol_to_a1(start + len(values) - 1, max(map(len, values), default=1))
+        return {"updates": {"updatedRange": f"{self.title}!A{start}:{end}"}}
+
+
+class FakeSpreadsheet:
+    def __init__(self, api: FakeAPI, sheets: Dict[str, List[List[str]]]):
+        self.api = api
+        self.sheets = {title: FakeWorksheet(api, title, values, sheet_id)
+                       for sheet_id, (title, values) in enumerate(sheets.items())}
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.api.call("worksheet")
+        return self.sheets[title]
+
+    def worksheets(self, exclude_hidden: bool = False) -> List[FakeWorksheet]:
+        self.api.call("worksheets")
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title: str, rows: int, cols: int, **kwargs) -> FakeWorksheet:
+        self.api.call("add_worksheet")
+        self.sheets[title] = FakeWorksheet(self.api, title, [], len(self.sheets))
+        return self.sheets[title]
+
+    def batch_update(self, body: dict) -> dict:
+        """Supporta solo le richieste deleteDimension sulle righe."""
+        self.api.call("spreadsheet_batch_update")
+        worksheets = {ws.id: ws for ws in self.sheets.values()}
+        for request in body["requests"]:
+            grid = request["deleteDimension"]["range"]
+            ws = worksheets[grid["sheetId"]]
+            with ws._lock:
+                del ws.values[grid["startIndex"]:grid["endIndex"]]
+        self.api.touch()
+        return {}
+
+    def get_lastUpdateTime(self) -> str:
+        self.api.call("get_lastUpdateTime")
+        return f"2024-01-01T00:00:00.{self.api.revision:06d}Z"
+
+    def values_batch_get(self, ranges: List[str], params: Optional[dict] = None) -> dict:
+        self.api.call("values_batch_get")
+        value_ranges = []
+        for range_name in ranges:
+            title, a1 = _split_range(range_name)
+            value_ranges.append({"range": range_name, "values": self.sheets[title]._slice(a1)})
+        return {"valueRanges": value_ranges}
+
+
+class FakeClient:
+    def __init__(self, sheets: Dict[str, List[List[str]]], latency: float = 0.0):
+        self.api = FakeAPI(latency)
+        self.spreadsheet = FakeSpreadsheet(self.api, sheets)
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        self.api.call("open_by_key")
+        return self.spreadsheet
@@ -0,0 +1,74 @@
+"""
+Generatore di archivi sintetici (fogli database, prenotazioni, gestori)
+nel formato testuale restituito da Google Sheets.
+"""
+
+import random
+from datetime import date, timedelta
+from typing import Dict, List
+
+from schema import PRENOTAZIONI_COLUMNS
+
+
+DATABASE_COLUMNS = ['PORTAFOGLIO', 'NDG', 'NOMINATIVO', 'SCATOLA', 'ID_CREDITLINE_ACERO']
+
+MOTIVAZIONI = [
+    "Scansione intero fascicolo (solo se completamente assente o privo di documentazione rilevante)",
+    "Richiesta fascicolo CARTACEO",
+]
+
+# Numero di fascicoli e di prenotazioni per dimensione
+SIZES = {
+    "1k": (1_000, 200),
+    "100k": (100_000, 20_000),
+    "1m": (1_000_000, 200_000),
+}
+
+
+def generate_archive(n_fascicoli: int, n_prenotazioni: int, n_portafogli: int = 20,
+                     n_gestori: int = 50, returned_ratio: float = 0.8,
+                     seed: int = 42) -> Dict[str, List[List[str]]]:
+    rnd = random.Random(seed)
+    portafogli = [f"PORTAFOGLIO_{i:02d}" for i in range(n_portafogli)]
+
+    database = [list(DATABASE_COLUMNS)]
+    for i in range(n_fascicoli):
+        database.append([
+            rnd.choice(portafogli),
+            str(1_000_000 + i) if rnd.random() < 0.8 else f"{100_000 + i}-{rnd.randint(1, 9)}",
+            f"COGNOME{rnd.randint(1, 50_000)} NOME{rnd.randint(1, 5_000)}",
+            f"SC{rnd.randint(1, max(1, n_fascicoli // 50)):06d}",
+            str(rnd.randint(10_000_000, 99_999_999)),
+        ])
+
+    gestori = [['NOME_VIS']] + [[f"Gestore {i:03d}"] for i in range(n_gestori)]
+
+    start = date(2023, 1, 1)
+    prenotazioni = [list(PRENOTAZIONI_COLUMNS)]
+    for _ in range(n_prenotazioni):
+        fascicolo = database[rnd.randint(1, n_fascicoli)]
+        returned = rnd.random() < returned_ratio
+        requested = start + timedelta(days=rnd.randint(0, 900))
+        record = {
+            'PORTAFOGLIO': fascicolo[0],
+            'NDG': fascicolo[1],
+            'DATA_RICHIESTA': requested.strftime('%d/%m/%Y'),
+            'PRENOTATO': 'TRUE',
+            'RESTITUITO': 'TRUE' if returned else 'FALSE',
+            'DATA_EVASIONE': (requested + timedelta(days=3)).strftime('%d/%m/%Y') if returned else '',
+            'DATA_RESTITUZIONE': (requested + timedelta(days=30)).strftime('%d/%m/%Y') if returned else '',
+            'GESTORE': rnd.choice(gestori[1:])[0],
+            'MOTIVAZIONE_RICHIESTA': rnd.choice(MOTIVAZIONI),
+            'NOTE': '-',
+            'MOTIVO_SINGOLO_DOC': '-',
+            'INDIC_DOC_SCANSIONARE': '-',
+            'DETTAGLIO_RICHIESTA_INTERO': '-',
+        }
+        prenotazioni.append([record[col] for col in PRENOTAZIONI_COLUMNS])
+
+    return {"database": database, "prenotazioni": prenotazioni, "gestori": gestori}
+
+
+def generate_size(size: str, seed: int = 42) -> Dict[str, List[List[str]]]:
+    n_fascicoli, n_prenotazioni = SIZES[size]
+    return generate_archive(n_fascicoli, n_prenotazioni, seed=seed)
@@ -0,0 +1,364 @@
+"""
+Benchmark offline dei percorsi caldi dell'app, su un finto client gspread.
+
+Uso (dalla radice del repository):
+
+    python -m bench.run --sizes 1k 100k --latency-ms 50 --output bench_report.json
+
+Per ogni dimensione dell'archivio misura il caricamento dei fogli (anche a
+regime, con e senza modifiche), le opzioni dei filtri di ricerca, il
+controllo duplicati e il salvataggio di una prenotazione, sia con
+l'implementazione attuale sia con quella originale (scenari *_baseline), e
+scrive un report JSON confrontabile tra esecuzioni. mixed_updates verifica
+che evasioni e restituzioni miste non alterino le altre colonne; gli scenari
+concurrent_* verificano che nessuna prenotazione attiva risulti duplicata,
+anche con più istanze dell'app dietro code write-behind separate.
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from bench.fake_gspread import FakeClient
+from bench.generate import MOTIVAZIONI, SIZES, generate_size
+from indexes import BookingIndex, DuplicateBookingError
+from metrics import METRICS
+from schema import BOOL_COLUMNS, PRENOTAZIONI_COLUMNS, normalize_prenotazioni
+from snapshot import SnapshotStore
+from storage import GoogleSheetsRepository, WriteBehindRepository
+
+
+GSHEET_ID = "bench"
+
+
+def measure(fn: Callable[[], None], repeat: int, client: FakeClient) -> Dict[str, float]:
+    """Esegue `fn` `repeat` volte; tempi in millisecondi e chiamate API per esecuzione."""
+    timings = []
+    calls_before = client.api.total_calls
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "runs": repeat,
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "p50_ms": round(timings[len(timings) // 2], 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "max_ms": round(timings[-1], 3),
+        "api_calls_per_run": round((client.api.total_calls - calls_before) / repeat, 2),
+    }
+
+
+def booking_row(ndg: str, portafoglio: str, motivazione: str) -> List[str]:
+    record = {
+        'PORTAFOGLIO': portafoglio, 'NDG': ndg, 'DATA_RICHIESTA': time.strftime('%d/%m/%Y'),
+        'PRENOTATO': 'TRUE', 'RESTITUITO': 'FALSE', 'GESTORE': 'Gestore 000',
+        'MOTIVAZIONE_RICHIESTA': motivazione,
+    }
+    return [record.get(col, '-') for col in PRENOTAZIONI_COLUMNS]
+
+
+def booking_frame(row: List[str]) -> pd.DataFrame:
+    return normalize_prenotazioni(pd.DataFrame([dict(zip(PRENOTAZIONI_COLUMNS, row))]))
+
+
+# --- implementazione originale, come riferimento ---
+def load_baseline(client: FakeClient):
+    sh = client.open_by_key(GSHEET_ID)
+    worksheets = {name: sh.worksheet(name) for name in ("database", "prenotazioni", "gestori")}
+    dfs = {name: pd.DataFrame(ws.get_all_records()) for name, ws in worksheets.items()}
+    for col in BOOL_COLUMNS:
+        dfs['prenotazioni'][col] = dfs['prenotazioni'][col].astype(str).str.upper().map(
+            {'TRUE': True, 'FALSE': False, '': False}).fillna(False)
+    for col in ['DATA_RICHIESTA', 'DATA_EVASIONE', 'DATA_RESTITUZIONE']:
+        dfs['prenotazioni'][col] = pd.to_datetime(dfs['prenotazioni'][col], format='%d/%m/%Y',
+                                                  dayfirst=True, errors='coerce')
+    return dfs['database'], dfs['prenotazioni'], dfs['gestori']
+
+
+def search_filters_baseline(df: pd.DataFrame, portafoglio: str):
+    portafogli_list = sorted(df['PORTAFOGLIO'].unique())
+    ndg_list = sorted(df[df['PORTAFOGLIO'] == portafoglio]['NDG'].unique().astype(str))
+    return portafogli_list, ndg_list
+
+
+def duplicate_check_baseline(prenotazioni: pd.DataFrame, key: str) -> bool:
+    active = prenotazioni[~prenotazioni['RESTITUITO']].copy()
+    active['check_key'] = active.apply(
+        lambda x: f"{str(x['NDG'])}_{str(x['PORTAFOGLIO'])}_{str(x['MOTIVAZIONE_RICHIESTA'])}", axis=1)
+    return key in active['check_key'].values
+
+
+# --- scenari ---
+def run_size(size: str, latency: float, repeat: int) -> Dict[str, Dict]:
+    archive = generate_size(size)
+    rnd = random.Random(7)
+    results = {}
+
+    def new_client() -> FakeClient:
+        return FakeClient({name: list(values) for name, values in archive.items()}, latency=latency)
+
+    # Caricamento completo come nell'implementazione originale
+    client = new_client()
+    results["load_baseline"] = measure(lambda: load_baseline(client), repeat, client)
+    database_raw, prenotazioni_raw, _ = load_baseline(client)
+
+    # Primo caricamento: repository + snapshot tipizzato e indicizzato
+    client = new_client()
+    results["load_cold"] = measure(
+        lambda: SnapshotStore(GoogleSheetsRepository(client.open_by_key(GSHEET_ID),
+                                                     normalize=normalize_prenotazioni).load).refresh(),
+        repeat, client)
+
+    # Refresh a regime: una prenotazione nuova tra un refresh e l'altro (delta)
+    client = new_client()
+    repo = GoogleSheetsRepository(client.open_by_key(GSHEET_ID), normalize=normalize_prenotazioni)
+    store = SnapshotStore(repo.load)
+    snap = store.refresh()
+    prenotazioni_ws = client.spreadsheet.sheets["prenotazioni"]
+
+    def steady_refresh():
+        # Modifica esterna al foglio (es. un'altra istanza dell'app)
+        prenotazioni_ws.values.append(booking_row(str(rnd.randint(1, 10**9)), "PORTAFOGLIO_00", MOTIVAZIONI[0]))
+        client.api.touch()
+        store.refresh()
+
+    results["load_steady_delta"] = measure(steady_refresh, repeat, client)
+    # Refresh senza modifiche: solo il controllo del modifiedTime
+    results["load_steady_unchanged"] = measure(store.refresh, repeat, client)
+    snap = store.get()
+
+    # Opzioni dei filtri di ricerca (render_search_filters)
+    portafogli = snap.portfolio_index.portafogli
+    results["search_filters_baseline"] = measure(
+        lambda: search_filters_baseline(database_raw, rnd.choice(portafogli)), repeat, client)
+    results["search_filters_index"] = measure(
+        lambda: snap.search_index.search(str(rnd.randint(1_000_000, 1_000_999)), rnd.choice(portafogli)),
+        repeat, client)
+    results["search_text_index"] = measure(
+        lambda: snap.search_index.search(f"COGNOME{rnd.randint(1, 999)}"), repeat, client)
+
+    # Controllo duplicati
+    sample = prenotazioni_raw.sample(1, random_state=1).iloc[0]
+    key = (str(sample['NDG']), str(sample['PORTAFOGLIO']), str(sample['MOTIVAZIONE_RICHIESTA']))
+    results["duplicate_check_baseline"] = measure(
+        lambda: duplicate_check_baseline(prenotazioni_raw, "_".join(key)), repeat, client)
+    results["duplicate_check_index"] = measure(
+        lambda: snap.booking_index.has_active_booking(*key), repeat, client)
+
+    # Salvataggio di una prenotazione (save_prenotazione)
+    def save():
+        row = booking_row(str(rnd.randint(1, 10**9)), "PORTAFOGLIO_01", MOTIVAZIONI[1])
+        new_df = booking_frame(row)
+        keys = set(BookingIndex.build(new_df).keys)
+        store.book(new_df, write=lambda: repo.append_prenotazioni_if_absent([row], keys))
+
+    results["save_prenotazione"] = measure(save, repeat, client)
+    results["mixed_updates"] = mixed_updates(new_client())
+    results["concurrent_bookings"] = concurrent_bookings(new_client())
+    results["concurrent_instances"] = concurrent_instances(new_client())
+    return results
+
+
+def concurrent_bookings(client: FakeClient, n_bookings: int = 300, n_keys: int = 20) -> Dict:
+    """
+    Prenotazioni concorrenti su poche chiavi: verifica che nessun duplicato
+    arrivi sul foglio (lock per chiave + compare-and-append).
+    """
+    repo = GoogleSheetsRepository(client.open_by_key(GSHEET_ID), normalize=normalize_prenotazioni)
+    store = SnapshotStore(repo.load)
+    store.refresh()
+    ws = client.spreadsheet.sheets["prenotazioni"]
+    rows_before = len(ws.values)
+    outcome = Counter()
+    lock = threading.Lock()
+
+    def book(i: int):
+        row = booking_row(f"STRESS-{i % n_keys}", "PORTAFOGLIO_STRESS", MOTIVAZIONI[0])
+        new_df = booking_frame(row)
+        keys = set(BookingIndex.build(new_df).keys)
+        try:
+            store.book(new_df, write=lambda: repo.append_prenotazioni_if_absent([row], keys))
+            result = "accepted"
+        except DuplicateBookingError:
+            result = "rejected"
+        with lock:
+            outcome[result] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=book, args=(i,)) for i in range(n_bookings)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = (time.perf_counter() - start) * 1000
+
+    written = Counter(tuple(row) for row in ws.values[rows_before:])
+    duplicates = sum(count - 1 for count in written.values())
+    assert duplicates == 0, f"{duplicates} prenotazioni duplicate sul foglio"
+    return {
+        "bookings": n_bookings,
+        "keys": n_keys,
+        "accepted": outcome["accepted"],
+        "rejected": outcome["rejected"],
+        "duplicates": duplicates,
+        "total_ms": round(elapsed, 3),
+    }
+
+
+def mixed_updates(client: FakeClient) -> Dict:
+    """
+    Evasioni e restituzioni nella stessa modifica (come "Segna come restituite"):
+    verifica che ogni riga riceva solo le proprie colonne e che le altre
+    restino quelle dello snapshot, identiche a una rilettura completa.
+    """
+    repo = GoogleSheetsRepository(client.open_by_key(GSHEET_ID), normalize=normalize_prenotazioni)
+    store = SnapshotStore(repo.load)
+    prenotazioni = store.refresh().prenotazioni
+    attive = [int(pos) for pos in prenotazioni[~prenotazioni['RESTITUITO']].index[:10]]
+    evase, da_evadere = attive[:5], attive[5:]
+    keys = {pos: (str(prenotazioni.at[pos, 'NDG']), str(prenotazioni.at[pos, 'PORTAFOGLIO']),
+                  str(prenotazioni.at[pos, 'MOTIVAZIONE_RICHIESTA'])) for pos in attive}
+
+    def update(changes: Dict[int, Dict[str, str]]):
+        return store.update_prenotazioni(changes, write=lambda: repo.update_prenotazioni(
+            [(pos, keys[pos], values) for pos, values in changes.items()]))
+
+    update({pos: {'DATA_EVASIONE': '01/01/2024'} for pos in evase})
+    oggi = time.strftime("%d/%m/%Y")
+    changes = {pos: {'RESTITUITO': 'TRUE', 'DATA_RESTITUZIONE': oggi} for pos in evase}
+    changes.update({pos: {'DATA_EVASIONE': oggi} for pos in da_evadere})
+    start = time.perf_counter()
+    snap = update(changes)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    columns = ['RESTITUITO', 'DATA_EVASIONE', 'DATA_RESTITUZIONE']
+    reloaded = SnapshotStore(GoogleSheetsRepository(client.open_by_key(GSHEET_ID),
+                                                    normalize=normalize_prenotazioni).load).refresh()
+    positions = list(changes)
+    mismatches = int((~(snap.prenotazioni.loc[positions, columns].eq(reloaded.prenotazioni.loc[positions, columns])
+                        | (snap.prenotazioni.loc[positions, columns].isna()
+                           & reloaded.prenotazioni.loc[positions, columns].isna()))).to_numpy().sum())
+    assert mismatches == 0, f"{mismatches} celle dello snapshot diverse dal foglio dopo l'aggiornamento"
+    assert snap.prenotazioni.loc[evase, 'DATA_EVASIONE'].notna().all(), "DATA_EVASIONE sovrascritta"
+    return {"updated": len(changes), "mismatches": mismatches, "total_ms": round(elapsed, 3)}
+
+
+def concurrent_instances(client: FakeClient, n_instances: int = 3, n_bookings: int = 60,
+                         n_keys: int = 5) -> Dict:
+    """
+    Più istanze dell'app sullo stesso foglio, ciascuna con il proprio store e la
+    propria coda write-behind (come app.py con Google Sheets): le prenotazioni
+    accodate da istanze diverse sulla stessa chiave si scartano in flush().
+    """
+    journal_dir = tempfile.mkdtemp(prefix="bench_journal_")
+    instances = []
+    for i in range(n_instances):
+        repo = WriteBehindRepository(
+            GoogleSheetsRepository(client.open_by_key(GSHEET_ID), normalize=normalize_prenotazioni),
+            journal_path=f"{journal_dir}/journal_{i}.jsonl", flush_seconds=0.05)
+        store = SnapshotStore(repo.load)
+        store.refresh()
+        instances.append((repo, store))
+    ws = client.spreadsheet.sheets["prenotazioni"]
+    rows_before = len(ws.values)
+    outcome = Counter()
+    queued: List[List[List[str]]] = [[] for _ in instances]
+    lock = threading.Lock()
+
+    def book(i: int):
+        repo, store = instances[i % n_instances]
+        row = booking_row(f"MULTI-{i % n_keys}", "PORTAFOGLIO_MULTI", MOTIVAZIONI[0])
+        new_df = booking_frame(row)
+        keys = set(BookingIndex.build(new_df).keys)
+        try:
+            store.book(new_df, write=lambda: repo.append_prenotazioni_if_absent([row], keys))
+            result = "queued"
+        except DuplicateBookingError:
+            result = "rejected"
+        with lock:
+            outcome[result] += 1
+            if result == "queued":
+                queued[i % n_instances].append(row)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=book, args=(i,)) for i in range(n_bookings)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    while any(repo.write_status().pending for repo, _ in instances):
+        time.sleep(0.01)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    # Le righe annullate dalla riconciliazione restano sul foglio, restituite
+    header = ws.values[0]
+    restituito = header.index('RESTITUITO')
+    new_rows = ws.values[rows_before:]
+    active = Counter(tuple(row) for row in new_rows if row[restituito] == 'FALSE')
+    duplicates = sum(count - 1 for count in active.values())
+    assert duplicates == 0, f"{duplicates} prenotazioni attive duplicate sul foglio"
+    # Ogni riga accodata è attiva sul foglio o riportata come scartata a chi l'ha inviata
+    rejected_at_flush = sum(len(repo.queue_outcome(rows)[0]) for (repo, _), rows in zip(instances, queued))
+    assert sum(active.values()) + rejected_at_flush == outcome["queued"], "righe accodate senza esito"
+    return {
+        "instances": n_instances,
+        "bookings": n_bookings,
+        "keys": n_keys,
+        "queued": outcome["queued"],
+        "rejected": outcome["rejected"],
+        "rejected_at_flush": rejected_at_flush,
+        "written": len(new_rows),
+        "cancelled": len(new_rows) - sum(active.values()),
+        "duplicates": duplicates,
+        "total_ms": round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1k", "100k"], choices=sorted(SIZES))
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latenza simulata per chiamata API")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="bench_report.json")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "latency_ms": args.latency_ms,
+            "repeat": args.repeat,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+        "phases": {},
+    }
+    for size in args.sizes:
+        print(f"== {size}")
+        results = run_size(size, args.latency_ms / 1000, args.repeat)
+        report["results"][size] = results
+        for name, stats in results.items():
+            summary = ", ".join(f"{k}={v}" for k, v in stats.items())
+            print(f"  {name:<26} {summary}")
+
+    # Tempi per fase registrati dalla strumentazione dei moduli (metrics.py)
+    report["phases"] = METRICS.summary()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report scritto in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
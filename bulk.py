@@ -0,0 +1,97 @@
+"""
+Import massivo di prenotazioni da file CSV o Excel.
+
+Il file ha le colonne PORTAFOGLIO, NDG, MOTIVAZIONE e (facoltativa) NOTE.
+Tutte le righe si validano in un solo passaggio vettoriale contro il foglio
+database e le prenotazioni attive dello snapshot; le righe accettate
+diventano righe del foglio prenotazioni, scritte poi con un unico append.
+"""
+
+import io
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from gspread.utils import numericise_all
+
+from indexes import BookingIndex
+from schema import PRENOTAZIONI_COLUMNS
+
+
+IMPORT_COLUMNS = ['PORTAFOGLIO', 'NDG', 'MOTIVAZIONE', 'NOTE']
+
+# Intestazioni alternative accettate nel file
+COLUMN_ALIASES = {'MOTIVAZIONE_RICHIESTA': 'MOTIVAZIONE', 'NOTA': 'NOTE'}
+
+# Righe massime per file
+MAX_IMPORT_ROWS = 5000
+
+
+def read_upload(filename: str, data: bytes) -> pd.DataFrame:
+    """Legge il file caricato come testo; ValueError se il formato o le colonne non sono validi."""
+    if filename.lower().endswith(".xlsx"):
+        upload = pd.read_excel(io.BytesIO(data), dtype=str)
+    elif filename.lower().endswith(".csv"):
+        # Separatore rilevato dal file (Excel italiano esporta con ';')
+        upload = pd.read_csv(io.BytesIO(data), dtype=str, sep=None, engine="python", encoding="utf-8-sig")
+    else:
+        raise ValueError("Formato non supportato: caricare un file .csv o .xlsx")
+
+    upload.columns = [str(c).strip().upper() for c in upload.columns]
+    upload = upload.rename(columns=COLUMN_ALIASES)
+    missing = [c for c in IMPORT_COLUMNS[:3] if c not in upload.columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti nel file: {', '.join(missing)}")
+    if len(upload) > MAX_IMPORT_ROWS:
+        raise ValueError(f"Il file contiene {len(upload)} righe: il massimo è {MAX_IMPORT_ROWS}")
+
+    upload = upload.reindex(columns=IMPORT_COLUMNS).fillna('')
+    for col in IMPORT_COLUMNS:
+        upload[col] = upload[col].astype(str).str.strip()
+    # Stessa conversione numerica dei fogli (es. NDG '0123' -> '123'), così le chiavi coincidono
+    for col in ('PORTAFOGLIO', 'NDG'):
+        upload[col] = [str(v) for v in numericise_all(upload[col].tolist(), False, "", False, None)]
+    upload.index = pd.RangeIndex(2, len(upload) + 2, name='RIGA')
+    return upload
+
+
+def validate_bookings(upload: pd.DataFrame, database: pd.DataFrame, booking_index: BookingIndex,
+                      motivazioni: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Valida tutte le righe insieme. Restituisce (accettate, scartate); le
+    scartate hanno la colonna ESITO con il primo motivo di scarto.
+    """
+    fascicoli = pd.MultiIndex.from_arrays([database['NDG'].astype(str), database['PORTAFOGLIO'].astype(str)])
+    keys = pd.MultiIndex.from_arrays([upload['NDG'], upload['PORTAFOGLIO'], upload['MOTIVAZIONE']])
+
+    missing = (upload[['PORTAFOGLIO', 'NDG', 'MOTIVAZIONE']] == '').any(axis=1).to_numpy()
+    bad_motivazione = ~upload['MOTIVAZIONE'].isin(motivazioni).to_numpy()
+    not_found = ~pd.MultiIndex.from_arrays([upload['NDG'], upload['PORTAFOGLIO']]).isin(fascicoli)
+    already_booked = keys.isin(list(booking_index.keys))
+    duplicated = keys.duplicated(keep='first')
+
+    esito = np.select(
+        [missing, bad_motivazione, not_found, already_booked, duplicated],
+        ["Campi obbligatori mancanti", "Motivazione non valida", "Fascicolo non trovato",
+         "Prenotazione attiva già presente", "Riga duplicata nel file"],
+        default="",
+    )
+    rejected = upload[esito != ""].assign(ESITO=esito[esito != ""])
+    return upload[esito == ""], rejected
+
+
+def build_prenotazioni(accepted: pd.DataFrame, gestore: str, data_richiesta: str) -> pd.DataFrame:
+    """Righe del foglio prenotazioni (testo, nell'ordine delle colonne) per le righe accettate."""
+    rows = pd.DataFrame({
+        'PORTAFOGLIO': accepted['PORTAFOGLIO'],
+        'NDG': accepted['NDG'],
+        'DATA_RICHIESTA': data_richiesta,
+        'PRENOTATO': 'TRUE',
+        'RESTITUITO': 'FALSE',
+        'DATA_EVASIONE': '',
+        'DATA_RESTITUZIONE': '',
+        'GESTORE': gestore,
+        'MOTIVAZIONE_RICHIESTA': accepted['MOTIVAZIONE'],
+        'NOTE': accepted['NOTE'].replace('', '-'),
+    }, index=accepted.index)
+    return rows.reindex(columns=PRENOTAZIONI_COLUMNS, fill_value='-')
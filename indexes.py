@@ -0,0 +1,387 @@
+"""
+Indici costruiti una sola volta per snapshot, nel thread che aggiorna i dati,
+così che i rerun di Streamlit non debbano mai riscandire i DataFrame.
+"""
+
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+
+
+BookingKey = Tuple[str, str, str]
+
+# Colonne cercate per sottostringa dalla ricerca type-ahead
+TEXT_SEARCH_COLUMNS = ['NOMINATIVO', 'SCATOLA', 'ID_CREDITLINE_ACERO']
+
+# Filtro sulle posizioni di riga (es. solo il portafoglio selezionato)
+RowFilter = Callable[[np.ndarray], np.ndarray]
+
+# Lunghezza degli n-gram e numero massimo di risultati restituiti alla UI
+NGRAM = 3
+SEARCH_LIMIT = 50
+
+
+class DuplicateBookingError(Exception):
+    """Esiste già una prenotazione attiva per la stessa chiave NDG/Portafoglio/Motivazione."""
+
+    def __init__(self, keys: Iterable[BookingKey]):
+        self.keys = sorted(keys)
+        super().__init__(f"Prenotazione attiva già presente: {self.keys}")
+
+
+# Chiave di DataFrame.attrs con l'elenco completo dei portafogli, quando il
+# database contiene solo una parte delle righe (caricamento pigro)
+PORTAFOGLI_ATTR = "portafogli"
+
+
+@dataclass(frozen=True)
+class PortfolioIndex:
+    """
+    Opzioni del filtro Portafoglio, ordinate e con l'opzione vuota iniziale
+    usata dalla selectbox. Gli NDG si cercano con SearchIndex.
+    """
+    portafoglio_options: List[str]
+
+    @property
+    def portafogli(self) -> List[str]:
+        return self.portafoglio_options[1:]
+
+    @classmethod
+    @timed("portfolio_index")
+    def build(cls, database: pd.DataFrame) -> "PortfolioIndex":
+        if PORTAFOGLI_ATTR in database.attrs:
+            return cls(portafoglio_options=[''] + sorted(database.attrs[PORTAFOGLI_ATTR]))
+        if database.empty or 'PORTAFOGLIO' not in database.columns:
+            return cls([''])
+        return cls(portafoglio_options=[''] + sorted(database['PORTAFOGLIO'].astype(str).unique()))
+
+
+@dataclass(frozen=True)
+class NgramIndex:
+    """
+    Indice a trigrammi sui valori distinti (maiuscoli) di una colonna testuale.
+    Le posting list (trigramma -> valori) e la mappa valore -> righe sono
+    array ordinati in formato CSR, costruiti in modo vettoriale.
+    """
+    values: np.ndarray
+    alphabet: Dict[str, int]
+    gram_codes: np.ndarray
+    gram_starts: np.ndarray
+    gram_values: np.ndarray
+    value_starts: np.ndarray
+    value_rows: np.ndarray
+
+    def _gram_code(self, gram: str):
+        size = len(self.alphabet)
+        code = 0
+        for ch in gram:
+            if ch not in self.alphabet:
+                return None
+            code = code * size + self.alphabet[ch]
+        return code
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT,
+               row_filter: Optional[RowFilter] = None) -> np.ndarray:
+        """
+        Righe il cui valore contiene `query` (almeno NGRAM caratteri), al più
+        `limit`, eventualmente ristrette da `row_filter`. I candidati si
+        verificano a blocchi, fermandosi appena si raggiunge il limite.
+        """
+        query = query.upper()
+        if len(query) < NGRAM:
+            return np.empty(0, dtype=np.int64)
+
+        postings = []
+        for gram in {query[i:i + NGRAM] for i in range(len(query) - NGRAM + 1)}:
+            code = self._gram_code(gram)
+            pos = np.searchsorted(self.gram_codes, code) if code is not None else len(self.gram_codes)
+            if pos == len(self.gram_codes) or self.gram_codes[pos] != code:
+                return np.empty(0, dtype=np.int64)
+            postings.append(self.gram_values[self.gram_starts[pos]:self.gram_starts[pos + 1]])
+
+        # Si parte dalla posting list più corta; quelle molto più lunghe costano
+        # più dell'intersezione di quanto risparmino: ci pensa la verifica
+        postings.sort(key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if len(posting) > 8 * len(candidates):
+                break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+
+        found = []
+        n_found = 0
+        for start in range(0, len(candidates), limit):
+            chunk = candidates[start:start + limit]
+            # I trigrammi in comune non garantiscono la sottostringa: verifica sui candidati
+            if len(postings) > 1:
+                chunk = chunk[[query in value for value in self.values[chunk]]]
+            for v in chunk:
+                rows = self.value_rows[self.value_starts[v]:self.value_starts[v + 1]]
+                if row_filter is not None:
+                    rows = row_filter(rows)
+                found.append(rows)
+                n_found += len(rows)
+            if n_found >= limit:
+                break
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(found)[:limit]
+
+    @classmethod
+    def build(cls, column: pd.Series) -> "NgramIndex":
+        codes, uniques = pd.factorize(column.astype(str).str.upper())
+        values = np.asarray(uniques, dtype=object)
+        n_values = len(values)
+
+        value_rows = np.argsort(codes, kind='stable')
+        value_starts = np.searchsorted(codes[value_rows], np.arange(n_values + 1))
+
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=n_values)
+        width = int(lengths.max()) if n_values else 0
+        if width < NGRAM:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(values, {}, empty, np.zeros(1, dtype=np.int64), empty, value_starts, value_rows)
+
+        # Matrice dei caratteri (valori x posizioni) ricodificata su un alfabeto
+        # compatto con una tabella di lookup (niente ordinamenti)
+        chars = np.array(values.tolist(), dtype=f'U{width}').view(np.uint32).reshape(n_values, width)
+        present = np.zeros(int(chars.max()) + 1, dtype=bool)
+        present[chars.ravel()] = True
+        alphabet_chars = np.flatnonzero(present)
+        lookup = np.cumsum(present) - 1
+        mat = lookup[chars]
+        size = len(alphabet_chars)
+
+        grams = mat[:, :-2] * size * size + mat[:, 1:-1] * size + mat[:, 2:]
+        valid = np.arange(width - NGRAM + 1)[None, :] + NGRAM <= lengths[:, None]
+        value_ids = np.nonzero(valid)[0]
+        pairs = np.sort(grams[valid] * n_values + value_ids)
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+        gram_of_pair, value_of_pair = np.divmod(pairs, n_values)
+        gram_starts = np.flatnonzero(np.r_[True, gram_of_pair[1:] != gram_of_pair[:-1]])
+
+        return cls(
+            values=values,
+            alphabet={chr(c): i for i, c in enumerate(alphabet_chars)},
+            gram_codes=gram_of_pair[gram_starts],
+            gram_starts=np.append(gram_starts, len(pairs)),
+            gram_values=value_of_pair,
+            value_starts=value_starts,
+            value_rows=value_rows,
+        )
+
+
+@dataclass(frozen=True)
+class SearchIndex:
+    """
+    Ricerca type-ahead sul foglio database: prefisso di NDG (array ordinato,
+    ricerca binaria) e sottostringa di NOMINATIVO, SCATOLA e ID_CREDITLINE_ACERO
+    (indici a trigrammi). Restituisce posizioni di riga, al massimo `limit`.
+    """
+    ndg_sorted: np.ndarray
+    ndg_rows: np.ndarray
+    portafoglio_codes: np.ndarray
+    portafoglio_lookup: Dict[str, int]
+    text: Dict[str, NgramIndex]
+
+    def search(self, query: str, portafoglio: str = '', limit: int = SEARCH_LIMIT) -> np.ndarray:
+        query = query.strip()
+        if not query:
+            return np.empty(0, dtype=np.int64)
+
+        row_filter = None
+        if portafoglio:
+            code = self.portafoglio_lookup.get(portafoglio, -1)
+            row_filter = lambda rows: rows[self.portafoglio_codes[rows] == code]
+
+        # Prefisso di NDG: intervallo contiguo dell'array ordinato, filtrato a blocchi
+        lo = np.searchsorted(self.ndg_sorted, query, side='left')
+        hi = np.searchsorted(self.ndg_sorted, query + '\uffff', side='left')
+        parts, n_found = [], 0
+        for start in range(lo, hi, 8 * limit):
+            rows = self.ndg_rows[start:min(hi, start + 8 * limit)]
+            if row_filter is not None:
+                rows = row_filter(rows)
+            parts.append(rows)
+            n_found += len(rows)
+            if n_found >= limit:
+                break
+        for index in self.text.values():
+            if n_found >= limit:
+                break
+            rows = index.search(query, limit, row_filter)
+            parts.append(rows)
+            n_found += len(rows)
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate(parts)
+
+        # Dedup mantenendo l'ordine: prima i prefissi di NDG, poi le sottostringhe
+        _, first = np.unique(rows, return_index=True)
+        return rows[np.sort(first)][:limit]
+
+    @classmethod
+    @timed("search_index")
+    def build(cls, database: pd.DataFrame) -> "SearchIndex":
+        if database.empty or 'NDG' not in database.columns:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(np.empty(0, dtype=object), empty, empty, {}, {})
+
+        ndg = database['NDG'].astype(str).to_numpy(dtype=object)
+        ndg_rows = np.argsort(ndg, kind='stable')
+        portafoglio_codes, portafogli = pd.factorize(database['PORTAFOGLIO'].astype(str))
+        return cls(
+            ndg_sorted=ndg[ndg_rows],
+            ndg_rows=ndg_rows,
+            portafoglio_codes=portafoglio_codes,
+            portafoglio_lookup={p: i for i, p in enumerate(portafogli)},
+            text={col: NgramIndex.build(database[col]) for col in TEXT_SEARCH_COLUMNS
+                  if col in database.columns},
+        )
+
+
+@dataclass(frozen=True)
+class BookingIndex:
+    """
+    Prenotazioni attive (RESTITUITO = False) e insieme delle chiavi
+    (NDG, PORTAFOGLIO, MOTIVAZIONE_RICHIESTA) per il controllo duplicati in O(1).
+    """
+    active: pd.DataFrame
+    keys: FrozenSet[BookingKey]
+
+    @staticmethod
+    def make_key(ndg, portafoglio, motivazione) -> BookingKey:
+        return str(ndg), str(portafoglio), str(motivazione)
+
+    def has_active_booking(self, ndg, portafoglio, motivazione) -> bool:
+        return self.make_key(ndg, portafoglio, motivazione) in self.keys
+
+    def with_bookings(self, new_rows: pd.DataFrame) -> "BookingIndex":
+        """Nuovo indice con le righe aggiunte, senza ricalcolare quelle esistenti."""
+        added = BookingIndex.build(new_rows)
+        if added.active.empty:
+            return self
+        return BookingIndex(pd.concat([self.active, added.active]), self.keys | added.keys)
+
+    def with_updates(self, prenotazioni: pd.DataFrame, positions: Iterable[int]) -> "BookingIndex":
+        """
+        Nuovo indice dopo la modifica in-place delle righe `positions` del nuovo
+        DataFrame `prenotazioni` (es. restituzioni): si riesaminano solo quelle.
+        """
+        touched = self.active.index.intersection(list(positions))
+        if touched.empty:
+            return self
+        returned = touched[prenotazioni.loc[touched, 'RESTITUITO'].astype(bool).to_numpy()]
+        active = prenotazioni.loc[self.active.index.difference(returned)]
+        if returned.empty:
+            return BookingIndex(active, self.keys)
+
+        removed = set(BookingIndex.build(self.active.loc[returned]).keys)
+        # Una chiave resta attiva se un'altra riga attiva ha la stessa chiave
+        candidates = active[active['NDG'].astype(str).isin({ndg for ndg, _, _ in removed})]
+        still_active = removed & BookingIndex.build(candidates).keys
+        return BookingIndex(active, self.keys - (removed - still_active))
+
+    @classmethod
+    @timed("booking_index")
+    def build(cls, prenotazioni: pd.DataFrame) -> "BookingIndex":
+        if prenotazioni.empty or 'RESTITUITO' not in prenotazioni.columns:
+            return cls(prenotazioni.iloc[0:0], frozenset())
+
+        active = prenotazioni[~prenotazioni['RESTITUITO'].astype(bool)]
+        keys = frozenset(zip(
+            active['NDG'].astype(str),
+            active['PORTAFOGLIO'].astype(str),
+            active['MOTIVAZIONE_RICHIESTA'].astype(str),
+        ))
+        return cls(active, keys)
+
+
+@dataclass(frozen=True)
+class AvailabilityIndex:
+    """
+    Vista materializzata della disponibilità: per ogni riga del foglio database
+    se il fascicolo (NDG, PORTAFOGLIO) è libero e, per i fascicoli prenotati,
+    le motivazioni con una prenotazione attiva. Calcolata una volta per
+    snapshot con un join vettoriale e aggiornata solo per i fascicoli toccati
+    da nuove prenotazioni o restituzioni.
+    """
+    available: np.ndarray
+    booked: Dict[Tuple[str, str], FrozenSet[str]]
+    ndg_sorted: np.ndarray
+    ndg_rows: np.ndarray
+    portafogli: np.ndarray
+
+    @property
+    def n_available(self) -> int:
+        return int(self.available.sum())
+
+    def motivazioni(self, ndg, portafoglio) -> FrozenSet[str]:
+        return self.booked.get((str(ndg), str(portafoglio)), frozenset())
+
+    def _rows(self, ndg: str, portafoglio: str) -> np.ndarray:
+        lo = np.searchsorted(self.ndg_sorted, ndg, side='left')
+        hi = np.searchsorted(self.ndg_sorted, ndg, side='right')
+        rows = self.ndg_rows[lo:hi]
+        return rows[self.portafogli[rows] == portafoglio]
+
+    def _with_booked(self, booked: Dict[Tuple[str, str], FrozenSet[str]],
+                     changed: Iterable[Tuple[str, str]]) -> "AvailabilityIndex":
+        available = self.available.copy()
+        for key in changed:
+            available[self._rows(*key)] = key not in booked
+        return replace(self, available=available, booked=booked)
+
+    def with_bookings(self, new_rows: pd.DataFrame) -> "AvailabilityIndex":
+        """Vista aggiornata con le prenotazioni appena aggiunte."""
+        added = BookingIndex.build(new_rows).keys
+        if not added:
+            return self
+        booked = dict(self.booked)
+        for ndg, portafoglio, motivazione in added:
+            booked[(ndg, portafoglio)] = booked.get((ndg, portafoglio), frozenset()) | {motivazione}
+        return self._with_booked(booked, {(ndg, portafoglio) for ndg, portafoglio, _ in added})
+
+    def with_returns(self, keys: Iterable[BookingKey]) -> "AvailabilityIndex":
+        """Vista aggiornata dopo la restituzione delle prenotazioni `keys`."""
+        booked = dict(self.booked)
+        changed = set()
+        for ndg, portafoglio, motivazione in keys:
+            remaining = booked.get((ndg, portafoglio), frozenset()) - {motivazione}
+            if remaining:
+                booked[(ndg, portafoglio)] = remaining
+            else:
+                booked.pop((ndg, portafoglio), None)
+            changed.add((ndg, portafoglio))
+        return self._with_booked(booked, changed)
+
+    @classmethod
+    @timed("availability_index")
+    def build(cls, database: pd.DataFrame, booking_index: BookingIndex) -> "AvailabilityIndex":
+        if database.empty or 'NDG' not in database.columns:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(np.empty(0, dtype=bool), {}, np.empty(0, dtype=object), empty,
+                       np.empty(0, dtype=object))
+
+        active = booking_index.active
+        booked = {}
+        if not active.empty:
+            motivazioni = active['MOTIVAZIONE_RICHIESTA'].astype(str).groupby(
+                [active['NDG'].astype(str), active['PORTAFOGLIO'].astype(str)], observed=True)
+            booked = {key: frozenset(values) for key, values in motivazioni}
+
+        ndg = database['NDG'].astype(str).to_numpy(dtype=object)
+        portafogli = database['PORTAFOGLIO'].astype(str).to_numpy(dtype=object)
+        fascicoli = pd.MultiIndex.from_arrays([ndg, portafogli])
+        ndg_rows = np.argsort(ndg, kind='stable')
+        return cls(
+            available=~fascicoli.isin(list(booked)),
+            booked=booked,
+            ndg_sorted=ndg[ndg_rows],
+            ndg_rows=ndg_rows,
+            portafogli=portafogli,
+        )
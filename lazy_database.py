@@ -0,0 +1,192 @@
+"""
+Caricamento pigro del foglio database, per portafoglio.
+
+All'avvio si legge solo la colonna PORTAFOGLIO (intestazione + una colonna),
+che fornisce l'elenco dei portafogli e la posizione delle righe di ciascuno.
+Le righe di un portafoglio si scaricano alla prima selezione, con una
+richiesta values_batch_get sugli intervalli di righe che le contengono, e
+restano in una cache LRU di al più `max_portafogli` portafogli: avvio e
+memoria crescono con i portafogli effettivamente consultati.
+
+Con il foglio ordinato per PORTAFOGLIO ogni portafoglio è un solo
+intervallo; se le righe sono sparse, gli intervalli separati dai salti più
+brevi si uniscono (fino a RANGES_PER_REQUEST per portafoglio) e le righe di
+altri portafogli si scartano in locale.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from gspread.utils import absolute_range_name, numericise_all
+
+from indexes import PORTAFOGLI_ATTR
+from metrics import METRICS
+from sheets import FULL_RELOAD_SECONDS, column_letter, to_frame
+
+
+# Portafogli tenuti in memoria al più
+MAX_PORTAFOGLI = 8
+
+# Intervalli di righe per richiesta (i range vanno nella query string della GET)
+RANGES_PER_REQUEST = 100
+
+
+def _runs(rows: np.ndarray, limit: int) -> List[Tuple[int, int]]:
+    """
+    Numeri di riga ordinati -> al più `limit` intervalli [inizio, fine]
+    inclusivi che li coprono, unendo gli intervalli separati dai salti più brevi.
+    """
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1)
+    if len(breaks) >= limit:
+        gaps = rows[breaks + 1] - rows[breaks]
+        breaks = np.sort(breaks[np.argsort(gaps, kind="stable")[len(breaks) - (limit - 1):]])
+    starts = np.concatenate([[rows[0]], rows[breaks + 1]])
+    ends = np.concatenate([rows[breaks], [rows[-1]]])
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+class LazyDatabase:
+    """Cache LRU per portafoglio delle righe del worksheet database."""
+
+    def __init__(self, spreadsheet, worksheet, max_portafogli: int = MAX_PORTAFOGLI,
+                 column_reload_seconds: float = FULL_RELOAD_SECONDS):
+        self.spreadsheet = spreadsheet
+        self.worksheet = worksheet
+        self.max_portafogli = max_portafogli
+        self.column_reload_seconds = column_reload_seconds
+
+        self.header: List[str] = []
+        # Portafoglio di ciascuna riga dati (posizione 0 = riga 2 del foglio)
+        self.column = np.array([], dtype=object)
+        self.portafogli: List[str] = []
+        self._column_checksum: Optional[str] = None
+        self._column_loaded_at = 0.0
+        self._cache: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+        self._frame: Tuple[Optional[tuple], Optional[pd.DataFrame]] = (None, None)
+        self._lock = threading.RLock()
+
+    # --- colonna PORTAFOGLIO ---
+    def refresh_column(self, force: bool = False) -> bool:
+        """
+        Rilegge intestazione e colonna PORTAFOGLIO (ogni column_reload_seconds o
+        se forzato). Se le righe sono cambiate ricarica i portafogli in cache.
+        True se la colonna è cambiata.
+        """
+        with self._lock:
+            if not force and self.header and time.time() - self._column_loaded_at < self.column_reload_seconds:
+                return False
+            title = self.worksheet.title
+            if not self.header:
+                header = self.spreadsheet.values_batch_get([absolute_range_name(title, "1:1")])
+                self.header = [str(h) for h in (header["valueRanges"][0].get("values") or [[]])[0]]
+                while self.header and self.header[-1] == '':
+                    self.header.pop()
+            letter = column_letter(self.header.index('PORTAFOGLIO') + 1)
+            with METRICS.time("fetch_portafogli"):
+                response = self.spreadsheet.values_batch_get(
+                    [absolute_range_name(title, f"{letter}2:{letter}")])
+            values = response["valueRanges"][0].get("values", [])
+            self._column_loaded_at = time.time()
+
+            # Stessa conversione numerica del DataFrame (to_frame), così i nomi coincidono
+            raw = [str(row[0]).strip() if row else '' for row in values]
+            column = [str(v) for v in numericise_all(raw, False, "", False, None)]
+            checksum = hashlib.md5("\x1e".join(column).encode("utf-8")).hexdigest()
+            if checksum == self._column_checksum:
+                return False
+            self._column_checksum = checksum
+            self.column = np.array(column, dtype=object)
+            self.portafogli = sorted(set(column) - {''})
+            # Posizioni delle righe cambiate: i portafogli in cache si ricaricano insieme
+            cached = [p for p in self._cache if p in self.portafogli]
+            self._cache.clear()
+            self._frame = (None, None)
+            if cached:
+                self._fetch(cached)
+            return True
+
+    # --- portafogli ---
+    def _fetch(self, portafogli: List[str]):
+        """Scarica le righe dei portafogli indicati e le mette in cache."""
+        title = self.worksheet.title
+        last_col = column_letter(len(self.header))
+        plans: Dict[str, List[Tuple[int, int]]] = {}
+        ranges: List[str] = []
+        for portafoglio in portafogli:
+            rows = np.flatnonzero(self.column == portafoglio) + 2
+            plans[portafoglio] = _runs(rows, RANGES_PER_REQUEST)
+            ranges.extend(absolute_range_name(title, f"A{start}:{last_col}{end}")
+                          for start, end in plans[portafoglio])
+
+        values: List[List[List[str]]] = []
+        with METRICS.time("fetch_database_portafogli"):
+            for i in range(0, len(ranges), RANGES_PER_REQUEST):
+                response = self.spreadsheet.values_batch_get(ranges[i:i + RANGES_PER_REQUEST])
+                values.extend(r.get("values", []) for r in response.get("valueRanges", []))
+
+        width = len(self.header)
+        position = 0
+        for portafoglio in portafogli:
+            rows = []
+            for start, _ in plans[portafoglio]:
+                for row_number, r in enumerate(values[position], start=start):
+                    # Negli intervalli uniti ci sono anche righe di altri portafogli
+                    if row_number - 2 < len(self.column) and self.column[row_number - 2] == portafoglio:
+                        rows.append((list(map(str, r[:width])) + [''] * width)[:width])
+                position += 1
+            self._cache[portafoglio] = to_frame(self.header, rows)
+        self._frame = (None, None)
+
+    def load(self, portafogli: Iterable[str]) -> bool:
+        """
+        Garantisce che i portafogli siano in cache (una richiesta per quelli
+        mancanti) e li segna come usati di recente; oltre max_portafogli
+        scarta i meno recenti, mai quelli appena richiesti. True se ha scaricato.
+        """
+        with self._lock:
+            self.refresh_column()
+            requested = [p for p in dict.fromkeys(str(p) for p in portafogli) if p in self.portafogli]
+            missing = [p for p in requested if p not in self._cache]
+            if missing:
+                self._fetch(missing)
+                frames = [self._cache[p] for p in missing]
+                # Colonna non più allineata al foglio (righe inserite o rimosse): si
+                # rilegge, e con essa tutti i portafogli in cache
+                if any((f['PORTAFOGLIO'].astype(str) != p).any() for f, p in zip(frames, missing)):
+                    self.refresh_column(force=True)
+            for p in requested:
+                if p in self._cache:
+                    self._cache.move_to_end(p)
+            while len(self._cache) > max(self.max_portafogli, len(requested)):
+                self._cache.popitem(last=False)
+                self._frame = (None, None)
+            return bool(missing)
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Righe dei portafogli in cache, in un DataFrame riusato finché la cache
+        non cambia (lo snapshot non si ricalcola). attrs[PORTAFOGLI_ATTR]
+        contiene l'elenco completo dei portafogli.
+        """
+        with self._lock:
+            self.refresh_column()
+            key = tuple(sorted(self._cache))
+            cached_key, frame = self._frame
+            if frame is None or cached_key != key:
+                frames = [self._cache[p] for p in key]
+                frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=self.header)
+                frame.attrs[PORTAFOGLI_ATTR] = list(self.portafogli)
+                self._frame = (key, frame)
+            return frame
+
+    @property
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._cache)
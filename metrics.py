@@ -0,0 +1,172 @@
+"""
+Strumentazione dei percorsi caldi: durata di ciascuna fase (connessione,
+lettura dei fogli, normalizzazione, indici, rendering, salvataggio) raccolta
+in istogrammi per processo.
+
+Le percentili mostrate nell'app (p50/p95/p99) si calcolano sugli ultimi
+campioni di ogni fase; l'export in formato testo Prometheus usa i bucket
+cumulativi, su file o su un piccolo endpoint HTTP opzionale. Accanto agli
+istogrammi si possono registrare gauge (es. margine di quota API), letti
+al momento dell'export.
+"""
+
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+
+# Limiti superiori dei bucket, in secondi
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Campioni recenti conservati per fase, per le percentili
+RECENT_SAMPLES = 2048
+
+METRIC_NAME = "fbs_phase_duration_seconds"
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        samples = sorted(self.recent)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Metrics:
+    """Registro degli istogrammi per fase, condiviso tra le sessioni del processo."""
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        # nome -> (descrizione, nome dell'etichetta, funzione {valore etichetta: valore})
+        self._gauges: Dict[str, Tuple[str, str, Callable[[], Dict[str, float]]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, phase: str, seconds: float):
+        with self._lock:
+            self._histograms.setdefault(phase, Histogram()).observe(seconds)
+
+    @contextmanager
+    def time(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def timed(self, phase: str):
+        """Decoratore: misura ogni chiamata della funzione come fase `phase`."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(phase):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_gauges(self, name: str, help: str, label: str, read: Callable[[], Dict[str, float]]):
+        """Registra (o sostituisce) una famiglia di gauge `fbs_<name>`, calcolata a ogni lettura."""
+        with self._lock:
+            self._gauges[name] = (help, label, read)
+
+    def gauges(self) -> Dict[str, Dict[str, float]]:
+        """Valori correnti dei gauge registrati, per nome e valore dell'etichetta."""
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        return {name: read() for name, (_, _, read) in gauges}
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per fase: numero di campioni e p50/p95/p99 in millisecondi."""
+        with self._lock:
+            return {
+                phase: {
+                    "count": h.count,
+                    "p50_ms": h.percentile(0.50) * 1000,
+                    "p95_ms": h.percentile(0.95) * 1000,
+                    "p99_ms": h.percentile(0.99) * 1000,
+                }
+                for phase, h in sorted(self._histograms.items())
+            }
+
+    def to_prometheus(self) -> str:
+        """Istogrammi in formato testo Prometheus (exposition format 0.0.4)."""
+        lines = [
+            f"# HELP {METRIC_NAME} Durata delle fasi dei percorsi caldi dell'app.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        with self._lock:
+            for phase, h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{METRIC_NAME}_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'{METRIC_NAME}_bucket{{phase="{phase}",le="+Inf"}} {h.count}')
+                lines.append(f'{METRIC_NAME}_sum{{phase="{phase}"}} {h.sum}')
+                lines.append(f'{METRIC_NAME}_count{{phase="{phase}"}} {h.count}')
+            gauges = sorted(self._gauges.items())
+        for name, (help, label, read) in gauges:
+            lines.append(f"# HELP fbs_{name} {help}")
+            lines.append(f"# TYPE fbs_{name} gauge")
+            for value_label, value in sorted(read().items()):
+                lines.append(f'fbs_{name}{{{label}="{value_label}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """Scrive l'export Prometheus su file (es. per il textfile collector di node_exporter)."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Espone l'export Prometheus su http://host:port/metrics in un thread di background."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Registro unico del processo
+METRICS = Metrics()
+
+
+def timed(phase: str):
+    return METRICS.timed(phase)
@@ -0,0 +1,122 @@
+"""
+Coda locale delle prenotazioni accettate in modalità degradata.
+
+Mentre il backend non è raggiungibile le prenotazioni si annotano in un
+journal JSONL locale (un lotto per riga, sopravvive ai riavvii) e compaiono
+subito nello snapshot in memoria. Alla ripresa i lotti si reinviano, in
+ordine, con il percorso di scrittura normale (controllo duplicati compreso):
+un lotto in conflitto con prenotazioni fatte nel frattempo viene scartato
+per intero, come per il carrello, e segnalato alla sessione che lo aveva
+inviato (queue_outcome); gli scarti non reclamati scadono dopo REJECTED_TTL.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Callable, List, Tuple
+
+from indexes import DuplicateBookingError
+from storage import REJECTED_TTL
+
+
+def _row_id(row: List[str]) -> Tuple[str, ...]:
+    return tuple(str(v) for v in row)
+
+
+class OfflineQueue:
+    """Journal dei lotti di righe prenotazioni in attesa del backend."""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Righe scartate ai reinvii perché già prenotate nel frattempo, con l'ora
+        self._rejected: List[Tuple[float, List[str]]] = []
+        self.last_replay = 0.0
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._batches: List[List[List[str]]] = self._read()
+
+    def _read(self) -> List[List[List[str]]]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line)["rows"] for line in f if line.strip()]
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for rows in self._batches:
+                f.write(json.dumps({"rows": rows}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, rows: List[List[str]]):
+        """Accoda un lotto (una prenotazione, un carrello o un import)."""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"rows": rows}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._batches.append([list(r) for r in rows])
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(rows) for rows in self._batches)
+
+    def queue_outcome(self, rows: List[List[str]]) -> Tuple[List[List[str]], List[List[str]]]:
+        """Come Repository.queue_outcome: (scartate, ancora in coda) tra `rows`."""
+        wanted = {_row_id(row) for row in rows}
+        with self._lock:
+            rejected = [row for _, row in self._rejected if _row_id(row) in wanted]
+            self._rejected = [(at, row) for at, row in self._rejected if _row_id(row) not in wanted]
+            pending = [row for batch in self._batches for row in batch if _row_id(row) in wanted]
+        return rejected, pending
+
+    @property
+    def replaying(self) -> bool:
+        return self._replay_lock.locked()
+
+    def replay(self, book: Callable[[List[List[str]]], None]) -> int:
+        """
+        Reinvia i lotti in ordine con `book`. DuplicateBookingError scarta il
+        lotto; ogni altro errore interrompe il reinvio e viene rilanciato,
+        lasciando in coda i lotti non inviati. Restituisce le righe inviate.
+        """
+        sent = 0
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if not self._batches:
+                        break
+                    rows = self._batches[0]
+                rejected = []
+                try:
+                    book(rows)
+                    sent += len(rows)
+                except DuplicateBookingError:
+                    rejected = rows
+                with self._lock:
+                    # Le righe passano dalla coda agli scarti senza finestre intermedie
+                    self._batches.pop(0)
+                    self._rewrite()
+                    now = self.last_replay = time.time()
+                    self._rejected = [(at, row) for at, row in self._rejected if now - at < REJECTED_TTL]
+                    self._rejected.extend((now, row) for row in rejected)
+        return sent
+
+    def replay_in_background(self, book: Callable[[List[List[str]]], None],
+                             on_error: Callable[[Exception], None]):
+        """Avvia replay in un thread, se non è già in corso; gli errori vanno a `on_error`."""
+        if self.replaying:
+            return
+
+        def run():
+            try:
+                self.replay(book)
+            except Exception as e:
+                on_error(e)
+
+        threading.Thread(target=run, daemon=True).start()
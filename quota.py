@@ -0,0 +1,240 @@
+"""
+Client gspread consapevole delle quote API di Google Sheets.
+
+QuotaClient avvolge il client restituito da gspread (e gli Spreadsheet e
+Worksheet che produce) e fa passare ogni richiesta da un QuotaLimiter
+condiviso nel processo:
+
+- token bucket separati per letture e scritture, dimensionati sulla quota
+  per minuto: oltre il limite le richieste attendono invece di ricevere 429;
+- letture identiche già in corso (stesso oggetto, metodo e argomenti) sono
+  unite in una sola richiesta, il cui risultato è condiviso e va trattato
+  in sola lettura;
+- su 429 e, per le sole letture, su errori 5xx si riprova con backoff
+  esponenziale con jitter; dopo un 429 il bucket viene svuotato, così anche
+  le altre sessioni rallentano. Le scritture non si ripetono dopo un 5xx: la
+  richiesta potrebbe essere già stata eseguita (un append_rows ripetuto
+  duplica le prenotazioni, una deleteDimension cancella altre righe), il
+  recupero spetta a coda write-behind e coda offline;
+- margine di quota, attese, richieste unite e ritentativi sono esportati
+  come gauge in metrics.py.
+"""
+
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from gspread.exceptions import APIError
+
+from metrics import METRICS
+
+
+# Quote predefinite di Google Sheets per utente (service account) e minuto
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+
+# Codici HTTP per cui ha senso riprovare
+RETRY_CODES = frozenset({429, 500, 502, 503, 504})
+# Per le scritture solo 429: la richiesta è stata rifiutata prima di essere eseguita
+WRITE_RETRY_CODES = frozenset({429})
+
+
+class QuotaWaitTimeout(Exception):
+    """La quota locale non si è liberata entro il tempo massimo di attesa."""
+
+
+class TokenBucket:
+    """Token bucket: `rate` token al secondo, al massimo `capacity` accumulati."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: float) -> float:
+        """Preleva un token, attendendo al più `timeout` secondi. Restituisce l'attesa."""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return time.monotonic() - start
+                wait = (1 - self.tokens) / self.rate
+            if time.monotonic() - start + wait > timeout:
+                raise QuotaWaitTimeout(f"quota API esaurita: attesa oltre {timeout:.0f}s")
+            time.sleep(wait)
+
+    def drain(self):
+        """Azzera i token disponibili (dopo un 429 del server)."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class QuotaLimiter:
+    """Quote, unione delle letture e ritentativi, condivisi da tutto il processo."""
+
+    def __init__(self, reads_per_minute: float = READS_PER_MINUTE,
+                 writes_per_minute: float = WRITES_PER_MINUTE, max_wait: float = 60.0,
+                 max_retries: int = 5, base_backoff: float = 1.0, max_backoff: float = 32.0):
+        self.buckets = {"read": TokenBucket(reads_per_minute), "write": TokenBucket(writes_per_minute)}
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.stats = {"requests": 0, "coalesced": 0, "throttled": 0, "retries": 0, "rate_limited": 0}
+        self._in_flight: Dict[Hashable, _InFlight] = {}
+        self._lock = threading.Lock()
+        METRICS.register_gauges("quota_tokens_available", "Richieste API disponibili nel token bucket.",
+                                "kind", lambda: {kind: b.available for kind, b in self.buckets.items()})
+        METRICS.register_gauges("quota_events", "Richieste API, unite, rallentate, ritentate e rifiutate (429).",
+                                "event", lambda: dict(self.stats))
+
+    def _count(self, event: str):
+        with self._lock:
+            self.stats[event] += 1
+
+    def call(self, kind: Optional[str], fn: Callable[[], Any], key: Optional[Hashable] = None) -> Any:
+        """
+        Esegue `fn` rispettando la quota `kind` ("read", "write" o None per le
+        chiamate fuori quota Sheets). Con `key` le chiamate identiche
+        concorrenti condividono una sola richiesta.
+        """
+        if key is None:
+            return self._execute(kind, fn)
+
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _InFlight()
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._execute(kind, fn)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+    def _execute(self, kind: Optional[str], fn: Callable[[], Any]) -> Any:
+        bucket = self.buckets.get(kind)
+        retry_codes = WRITE_RETRY_CODES if kind == "write" else RETRY_CODES
+        attempt = 0
+        while True:
+            if bucket is not None:
+                waited = bucket.acquire(self.max_wait)
+                if waited > 0.001:
+                    self._count("throttled")
+                    METRICS.observe(f"quota_wait_{kind}", waited)
+            self._count("requests")
+            try:
+                return fn()
+            except APIError as e:
+                if e.code not in retry_codes or attempt >= self.max_retries:
+                    raise
+                if e.code == 429:
+                    self._count("rate_limited")
+                    if bucket is not None:
+                        bucket.drain()
+            attempt += 1
+            self._count("retries")
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+class _QuotaProxy:
+    """Inoltra gli attributi all'oggetto gspread; i metodi elencati passano dal limiter."""
+
+    READS: frozenset = frozenset()
+    WRITES: frozenset = frozenset()
+    # Chiamate che non consumano quota Sheets (es. Drive API) ma si uniscono e si ritentano
+    UNMETERED: frozenset = frozenset()
+
+    def __init__(self, target, limiter: QuotaLimiter):
+        self._target = target
+        self._limiter = limiter
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name in self.WRITES:
+            kind = "write"
+        elif name in self.READS:
+            kind = "read"
+        elif name in self.UNMETERED:
+            kind = None
+        else:
+            return attr
+
+        def call(*args, **kwargs):
+            key = None
+            if name not in self.WRITES:
+                key = (id(self._target), name, repr(args), repr(sorted(kwargs.items())))
+            return self._wrap(self._limiter.call(kind, lambda: attr(*args, **kwargs), key))
+
+        return call
+
+    def _wrap(self, result):
+        return result
+
+
+class QuotaWorksheet(_QuotaProxy):
+    READS = frozenset({"get", "get_all_values", "get_all_records", "get_values", "batch_get", "row_values",
+                       "col_values", "acell", "cell"})
+    WRITES = frozenset({"update", "batch_update", "append_row", "append_rows", "update_cell", "update_acell",
+                        "insert_row", "insert_rows", "delete_rows", "batch_clear", "clear"})
+
+
+class QuotaSpreadsheet(_QuotaProxy):
+    READS = frozenset({"values_get", "values_batch_get", "fetch_sheet_metadata", "worksheets", "worksheet",
+                       "get_worksheet", "get_worksheet_by_id"})
+    WRITES = frozenset({"values_update", "values_append", "values_batch_update", "values_clear", "batch_update",
+                        "add_worksheet"})
+    UNMETERED = frozenset({"get_lastUpdateTime"})
+
+    def _wrap(self, result):
+        if isinstance(result, list):
+            return [QuotaWorksheet(ws, self._limiter) for ws in result]
+        if hasattr(result, "append_rows"):
+            return QuotaWorksheet(result, self._limiter)
+        return result
+
+
+class QuotaClient(_QuotaProxy):
+    READS = frozenset({"open_by_key", "open", "open_by_url"})
+
+    def _wrap(self, result):
+        return QuotaSpreadsheet(result, self._limiter)
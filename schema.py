@@ -0,0 +1,118 @@
+"""
+Schema dei tre fogli: colonne, normalizzazione delle prenotazioni e tipi.
+
+I DataFrame costruiti dalle righe di Google Sheets hanno colonne object con
+valori misti (numeri e stringhe). Lo snapshot in memoria e la sua copia su
+disco usano invece tipi compatti: categorie per le colonne a bassa
+cardinalità, stringhe per NDG e per le altre colonne testuali; booleani e
+date restano quelli prodotti dalla normalizzazione delle prenotazioni.
+"""
+
+from typing import Dict, List
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+# Ordine delle colonne del foglio prenotazioni
+PRENOTAZIONI_COLUMNS = [
+                        'PORTAFOGLIO', 'NDG', 'DATA_RICHIESTA','PRENOTATO', 'RESTITUITO', 'DATA_EVASIONE', 'DATA_RESTITUZIONE',
+                        'GESTORE','MOTIVAZIONE_RICHIESTA','NOTE', 'MOTIVO_SINGOLO_DOC','INDIC_DOC_SCANSIONARE','DETTAGLIO_RICHIESTA_INTERO',
+                        ]
+
+# Colonne indispensabili all'app, per foglio (in qualsiasi ordine)
+SHEET_COLUMNS: Dict[str, List[str]] = {
+    "database": ['PORTAFOGLIO', 'NDG', 'NOMINATIVO', 'SCATOLA', 'ID_CREDITLINE_ACERO'],
+    "prenotazioni": PRENOTAZIONI_COLUMNS,
+    "gestori": ['NOME_VIS'],
+}
+
+BOOL_COLUMNS = ['PRENOTATO', 'RESTITUITO']
+
+DATE_COLUMNS = ['DATA_RICHIESTA', 'DATA_EVASIONE', 'DATA_RESTITUZIONE']
+
+CATEGORY_COLUMNS: Dict[str, List[str]] = {
+    "database": ['PORTAFOGLIO', 'SCATOLA'],
+    "prenotazioni": ['PORTAFOGLIO', 'GESTORE', 'MOTIVAZIONE_RICHIESTA', 'MOTIVO_SINGOLO_DOC'],
+    "gestori": [],
+}
+
+
+class SchemaError(ValueError):
+    """Un foglio della sorgente dati manca o non ha le colonne richieste dall'app."""
+
+
+def describe_schema() -> str:
+    """Fogli e colonne richiesti, per i messaggi di errore (es. "database: PORTAFOGLIO, NDG, ...")."""
+    return "; ".join(f"{name}: {', '.join(columns)}" for name, columns in SHEET_COLUMNS.items())
+
+
+def check_columns(frames: Dict[str, pd.DataFrame]):
+    """Verifica fogli e colonne di SHEET_COLUMNS; SchemaError con tutto ciò che manca."""
+    problems = []
+    for name, required in SHEET_COLUMNS.items():
+        frame = frames.get(name)
+        if frame is None or len(frame.columns) == 0:
+            problems.append(f"foglio '{name}' mancante o senza intestazione")
+            continue
+        missing = [col for col in required if col not in frame.columns]
+        if missing:
+            problems.append(f"foglio '{name}' senza le colonne {', '.join(missing)}")
+    if problems:
+        raise SchemaError("sorgente dati non valida: " + "; ".join(problems))
+
+
+def normalize_prenotazioni(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte colonne booleane e date del foglio prenotazioni.
+    Applicata dai Repository sia al caricamento completo sia alle sole righe nuove.
+    """
+    for col in BOOL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(str).str.upper().map({'TRUE': True, 'FALSE': False, '': False}).fillna(False)
+    
+    # CORREZIONE DATE: Converti le date con dayfirst=True per formato DD/MM/YYYY
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(
+                df[col], 
+                format='%d/%m/%Y', 
+                dayfirst=True,  # IMPORTANTE: forza il formato giorno/mese/anno
+                errors='coerce'
+            )
+    return df
+
+
+def apply_schema(name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Restituisce una copia di `df` con i tipi colonnari del foglio `name`."""
+    categories = CATEGORY_COLUMNS.get(name, [])
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if col in categories:
+            columns[col] = series.astype(str).astype('category')
+        elif col == 'NDG' or series.dtype == object:
+            columns[col] = series.astype(str)
+        else:
+            columns[col] = series
+    typed = pd.DataFrame(columns, index=df.index)
+    typed.attrs = dict(df.attrs)
+    return typed
+
+
+def concat_frames(name: str, frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatena DataFrame già tipizzati dello stesso foglio. pd.concat degrada a
+    object le categorie con valori diversi: qui si usa l'unione delle categorie.
+    """
+    out = pd.concat(frames)
+    for col in CATEGORY_COLUMNS.get(name, []):
+        parts = [f[col] for f in frames if col in f.columns]
+        if len(parts) == len(frames) and all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+            out[col] = pd.Categorical(union_categoricals(parts))
+    return out
+
+
+def frame_memory(df: pd.DataFrame) -> int:
+    """Byte occupati dal DataFrame, stringhe comprese."""
+    return int(df.memory_usage(deep=True).sum())
@@ -0,0 +1,208 @@
+"""
+Sincronizzazione incrementale dei worksheet Google Sheets.
+
+Ogni WorksheetSync tiene in memoria l'ultimo snapshot di un foglio e,
+per i fogli append-only (prenotazioni), scarica soltanto le righe
+aggiunte dopo l'ultima riga nota. Il download completo avviene solo
+al primo caricamento, quando la riga di controllo non coincide più
+(modifiche/cancellazioni in-place) o allo scadere di FULL_RELOAD_SECONDS.
+
+sync_batch() aggiorna più fogli con una sola richiesta values_batch_get.
+"""
+
+import hashlib
+import threading
+import time
+from contextlib import ExitStack
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+from gspread.utils import absolute_range_name, numericise_all, rowcol_to_a1
+
+from metrics import METRICS
+
+
+FULL_RELOAD_SECONDS = 120
+
+
+def column_letter(col: int) -> str:
+    """Restituisce la lettera di colonna A1 (1 -> 'A', 27 -> 'AA')."""
+    return rowcol_to_a1(1, col)[:-1]
+
+
+def update_digest(digest, rows: List[List[str]]):
+    for row in rows:
+        digest.update("\x1f".join(row).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest
+
+
+def to_frame(header: List[str], rows: List[List[str]],
+             normalize: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None) -> pd.DataFrame:
+    """Converte righe di stringhe in DataFrame con la stessa conversione numerica di get_all_records()."""
+    values = [numericise_all(row, False, "", False, None) for row in rows]
+    df = pd.DataFrame(values, columns=header)
+    if normalize is not None:
+        with METRICS.time("normalize"):
+            df = normalize(df)
+    return df
+
+
+class WorksheetSync:
+    """
+    Mantiene l'ultimo snapshot di un worksheet e lo aggiorna in modo incrementale.
+
+    Le righe sono conservate come stringhe (come restituite dall'API) e
+    convertite in DataFrame solo quando cambiano; il DataFrame viene
+    esteso con le sole righe nuove, applicando `normalize` al delta.
+    """
+
+    def __init__(self, worksheet, append_only: bool = False,
+                 normalize: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                 full_reload_seconds: float = FULL_RELOAD_SECONDS):
+        self.worksheet = worksheet
+        self.append_only = append_only
+        self.normalize = normalize
+        self.full_reload_seconds = full_reload_seconds
+
+        self.header: List[str] = []
+        self.rows: List[List[str]] = []
+        self.checksum: Optional[str] = None
+        self._digest = hashlib.md5()
+        self.frame: Optional[pd.DataFrame] = None
+        self.last_full_load = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def width(self) -> int:
+        return len(self.header)
+
+    def _needs_full_reload(self) -> bool:
+        return (not self.append_only
+                or not self.header
+                or time.time() - self.last_full_load > self.full_reload_seconds)
+
+    def invalidate(self):
+        """Forza un caricamento completo alla prossima sincronizzazione (es. righe rimosse dall'app)."""
+        with self._lock:
+            self.last_full_load = 0.0
+
+    def _pad(self, row: List[str]) -> List[str]:
+        row = [str(v) for v in row[:self.width]]
+        return row + [''] * (self.width - len(row))
+
+    def _to_frame(self, rows: List[List[str]]) -> pd.DataFrame:
+        return to_frame(self.header, rows, self.normalize)
+
+    def delta_range(self) -> str:
+        """
+        Range A1 da rileggere: parte dall'ultima riga nota (riga di controllo)
+        fino alla fine del foglio. Riga 1 = intestazione.
+        """
+        last_row = len(self.rows) + 1
+        return f"A{last_row}:{column_letter(self.width)}"
+
+    def _fetch(self, range_name: Optional[str] = None) -> List[List[str]]:
+        """Legge il foglio intero (range_name=None) o un range A1, misurando la chiamata."""
+        with METRICS.time(f"fetch_{self.worksheet.title}"):
+            if range_name is None:
+                return self.worksheet.get_all_values()
+            return self.worksheet.get(range_name, pad_values=True)
+
+    def batch_range(self) -> Tuple[bool, str]:
+        """
+        Range da includere in una richiesta batch: (True, foglio intero) se serve
+        un caricamento completo, altrimenti (False, righe dalla riga di controllo).
+        """
+        title = self.worksheet.title
+        if self._needs_full_reload():
+            return True, absolute_range_name(title)
+        return False, absolute_range_name(title, self.delta_range())
+
+    def sync(self) -> pd.DataFrame:
+        """Aggiorna lo snapshot (delta o completo) e restituisce il DataFrame."""
+        with self._lock:
+            if self._needs_full_reload():
+                self.apply_full(self._fetch())
+            else:
+                self.apply_delta(self._fetch(self.delta_range()))
+            return self.frame
+
+    def apply_full(self, values: List[List[str]]) -> bool:
+        """Sostituisce lo snapshot con il contenuto completo del foglio. True se è cambiato."""
+        self.last_full_load = time.time()
+        if not values or values == [[]]:
+            values = [self.header or []]
+
+        header = [str(h) for h in values[0]]
+        while header and header[-1] == '':
+            header.pop()
+        self.header = header
+        rows = [self._pad(r) for r in values[1:]]
+
+        digest = update_digest(hashlib.md5(), [header] + rows)
+        if digest.hexdigest() == self.checksum and self.frame is not None:
+            return False
+
+        self.rows = rows
+        self._digest = digest
+        self.checksum = digest.hexdigest()
+        self.frame = self._to_frame(rows)
+        return True
+
+    def apply_updates(self, rows: Dict[int, List[str]]):
+        """
+        Riflette modifiche in-place fatte dall'app (posizione -> riga completa)
+        senza rileggere il foglio: righe, checksum e solo le righe toccate del
+        DataFrame, aggiornato sul posto.
+        """
+        with self._lock:
+            positions = sorted(rows)
+            for pos in positions:
+                self.rows[pos] = self._pad(rows[pos])
+            self._digest = update_digest(hashlib.md5(), [self.header] + self.rows)
+            self.checksum = self._digest.hexdigest()
+            changed = self._to_frame([self.rows[pos] for pos in positions])
+            for col in changed.columns:
+                self.frame.loc[positions, col] = changed[col].to_numpy()
+
+    def apply_delta(self, values: List[List[str]]) -> bool:
+        """
+        Applica le righe lette da delta_range(). La prima riga deve coincidere
+        con l'ultima riga nota: se non coincide il foglio è stato modificato
+        in-place e si ricade su un caricamento completo.
+        """
+        reference = self.rows[-1] if self.rows else self.header
+        if not values or self._pad(values[0]) != reference:
+            self.apply_full(self._fetch())
+            return True
+
+        new_rows = [self._pad(r) for r in values[1:]]
+        if not new_rows:
+            return False
+
+        self.rows.extend(new_rows)
+        self.checksum = update_digest(self._digest, new_rows).hexdigest()
+        self.frame = pd.concat([self.frame, self._to_frame(new_rows)], ignore_index=True)
+        return True
+
+
+def sync_batch(spreadsheet, syncs: List[WorksheetSync]):
+    """
+    Aggiorna tutti i fogli con una sola chiamata values_batch_get: per ciascuno
+    il foglio intero o solo il delta, secondo batch_range(). La conversione
+    in righe/record avviene in locale, come per get_all_values().
+    """
+    with ExitStack() as stack:
+        for sync in syncs:
+            stack.enter_context(sync._lock)
+        plans = [sync.batch_range() for sync in syncs]
+        with METRICS.time("fetch_batch"):
+            response = spreadsheet.values_batch_get([range_name for _, range_name in plans])
+        value_ranges = response.get("valueRanges", [])
+        for sync, (full, _), value_range in zip(syncs, plans, value_ranges):
+            values = value_range.get("values", [])
+            if full:
+                sync.apply_full(values)
+            else:
+                sync.apply_delta(values)
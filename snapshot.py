@@ -0,0 +1,447 @@
+"""
+Snapshot condiviso dei dati, unico per processo.
+
+Tutte le sessioni Streamlit leggono lo stesso Snapshot. Il refresh è
+single-flight: un solo thread rilegge i fogli mentre gli altri continuano
+a servire la versione precedente. Ogni sessione può richiedere una
+versione minima (es. dopo una prenotazione) senza invalidare le altre.
+
+Se il caricamento fallisce (backend non raggiungibile, quota esaurita) lo
+store entra in modalità degradata: serve l'ultimo snapshot, anche quello
+ripristinato da disco, e un thread sonda il backend con backoff finché un
+caricamento non riesce.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from indexes import (AvailabilityIndex, BookingIndex, BookingKey, DuplicateBookingError, PortfolioIndex,
+                     SearchIndex)
+from metrics import METRICS
+from schema import SchemaError, apply_schema, check_columns, concat_frames, frame_memory, normalize_prenotazioni
+
+
+REFRESH_SECONDS = 10
+
+# Backoff dei tentativi di ricaricamento in modalità degradata, in secondi
+PROBE_BACKOFF = 5.0
+PROBE_MAX_BACKOFF = 300.0
+
+
+class BackendUnavailableError(Exception):
+    """Backend non raggiungibile e nessuno snapshot da servire."""
+
+    def __init__(self, error: Optional[Exception], retry_at: float):
+        super().__init__(f"backend non raggiungibile: {error}")
+        self.error = error
+        self.retry_at = retry_at
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Fotografia immutabile dei tre fogli, tipizzati secondo schema.py, e dei
+    relativi indici. I DataFrame sono condivisi tra le sessioni: vanno
+    trattati in sola lettura (nessuna copia per rerun).
+    """
+    version: int
+    loaded_at: float
+    database: pd.DataFrame
+    prenotazioni: pd.DataFrame
+    gestori: pd.DataFrame
+    portfolio_index: PortfolioIndex
+    search_index: SearchIndex
+    booking_index: BookingIndex
+    availability: AvailabilityIndex
+    # Byte occupati per foglio: (DataFrame grezzo, DataFrame tipizzato)
+    memory_report: Dict[str, Tuple[int, int]]
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.loaded_at
+
+
+class SnapshotDiskCache:
+    """
+    Copia su disco (Parquet, con i tipi colonnari dello snapshot) dell'ultimo snapshot
+    pubblicato, con la sua versione: a un riavvio lo store riparte da qui in
+    pochi millisecondi e rivalida i dati in background.
+    """
+
+    FRAMES = ("database", "prenotazioni", "gestori")
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._saved: Dict[str, pd.DataFrame] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.parquet")
+
+    def load(self) -> Optional[Tuple[dict, Dict[str, pd.DataFrame]]]:
+        """Metadati (version, saved_at) e DataFrame salvati, oppure None."""
+        meta_path = os.path.join(self.directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        frames = {name: pd.read_parquet(self._path(name)) for name in self.FRAMES}
+        return meta, frames
+
+    def save(self, snap: Snapshot):
+        """Riscrive solo i fogli cambiati dall'ultimo salvataggio; meta.json per ultimo."""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for name in self.FRAMES:
+                frame = getattr(snap, name)
+                if self._saved.get(name) is frame:
+                    continue
+                tmp_path = self._path(name) + ".tmp"
+                frame.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, self._path(name))
+                self._saved[name] = frame
+
+            meta_path = os.path.join(self.directory, "meta.json")
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"version": snap.version, "saved_at": snap.loaded_at}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+
+
+class KeyedLocks:
+    """
+    Lock per chiave di prenotazione, condivisi nel processo: serializzano solo
+    le prenotazioni sulla stessa chiave. Le chiavi sono acquisite in ordine
+    per evitare deadlock; un lock viene rimosso quando nessuno lo usa più.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: Dict[BookingKey, List] = {}
+
+    @contextmanager
+    def hold(self, keys: Iterable[BookingKey]):
+        keys = sorted(set(keys))
+        with self._guard:
+            entries = []
+            for key in keys:
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                entries.append(entry)
+        try:
+            with ExitStack() as stack:
+                for entry in entries:
+                    stack.enter_context(entry[0])
+                yield
+        finally:
+            with self._guard:
+                for key, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self._locks[key]
+
+
+class SnapshotStore:
+    """
+    Contenitore process-wide dello Snapshot corrente con versione
+    monotona crescente: la versione aumenta solo quando almeno uno dei
+    DataFrame restituiti dal loader cambia.
+    """
+
+    def __init__(self, loader: Callable[[], Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]],
+                 max_age: float = REFRESH_SECONDS, disk_cache: Optional[SnapshotDiskCache] = None,
+                 on_recover: Optional[Callable[[], None]] = None, probe_backoff: float = PROBE_BACKOFF,
+                 probe_max_backoff: float = PROBE_MAX_BACKOFF):
+        self.loader = loader
+        self.max_age = max_age
+        self.disk_cache = disk_cache
+        self.last_error: Optional[Exception] = None
+        # Chiamata (nel thread di sonda) quando il backend torna raggiungibile
+        self.on_recover = on_recover
+        self.probe_backoff = probe_backoff
+        self.probe_max_backoff = probe_max_backoff
+        self.degraded_since: Optional[float] = None
+        self.next_probe_at = 0.0
+        self._probing = False
+        self._degraded_lock = threading.Lock()
+        self._snapshot: Optional[Snapshot] = None
+        # DataFrame restituiti dall'ultimo load, per riconoscere i fogli cambiati
+        self._raw: Dict[str, pd.DataFrame] = {}
+        self._refresh_lock = threading.Lock()
+        self._booking_locks = KeyedLocks()
+        if disk_cache is not None:
+            self._restore()
+
+    def _restore(self):
+        """
+        Riparte dall'ultimo snapshot salvato su disco. Il suo loaded_at è quello
+        originale, quindi il primo get() lo serve subito e avvia la rivalidazione.
+        """
+        try:
+            saved = self.disk_cache.load()
+        except Exception as e:
+            # Copia su disco illeggibile: si carica dal backend come a freddo
+            self.last_error = e
+            return
+        if saved is None:
+            return
+        meta, frames = saved
+        snap = self._publish(**frames)
+        self._snapshot = replace(snap, version=meta["version"], loaded_at=meta["saved_at"])
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version if self._snapshot is not None else 0
+
+    @property
+    def degraded(self) -> bool:
+        return self.degraded_since is not None
+
+    def _stale(self) -> Snapshot:
+        """Snapshot servito in modalità degradata; BackendUnavailableError se non ce n'è uno."""
+        snap = self._snapshot
+        if snap is None:
+            raise BackendUnavailableError(self.last_error, self.next_probe_at)
+        return snap
+
+    def get(self, min_version: int = 0) -> Snapshot:
+        """
+        Restituisce lo snapshot corrente. Blocca solo se non esiste ancora
+        o se è più vecchio di `min_version`; se è solo scaduto avvia un
+        refresh in background e restituisce intanto la versione precedente.
+        In modalità degradata restituisce sempre l'ultimo snapshot.
+        """
+        if self.degraded:
+            return self._stale()
+        snap = self._snapshot
+        if snap is None or snap.version < min_version:
+            return self.refresh()
+        if snap.age > self.max_age:
+            self.refresh_in_background()
+        return snap
+
+    def refresh(self) -> Snapshot:
+        """
+        Rilegge i dati (single-flight). Se un altro thread ha completato un
+        refresh mentre si era in attesa del lock, si riusa il suo risultato.
+        Se il caricamento fallisce restituisce lo snapshot precedente, se c'è.
+        """
+        if self.degraded:
+            return self._stale()
+        requested_at = time.time()
+        with self._refresh_lock:
+            snap = self._snapshot
+            if snap is not None and snap.loaded_at >= requested_at:
+                return snap
+            try:
+                return self._load()
+            except Exception:
+                if snap is None:
+                    raise
+                return snap
+
+    def refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # Si continua a servire lo snapshot precedente
+            self.last_error = e
+
+    def mark_degraded(self, error: Exception):
+        """
+        Entra in modalità degradata (se non lo è già) e avvia la sonda del
+        backend: tentativi di caricamento con backoff esponenziale con jitter.
+        """
+        with self._degraded_lock:
+            self.last_error = error
+            if self.degraded_since is None:
+                self.degraded_since = time.time()
+            if self._probing:
+                return
+            self._probing = True
+        threading.Thread(target=self._probe, daemon=True).start()
+
+    def _probe(self):
+        attempts = 0
+        while True:
+            attempts += 1
+            delay = min(self.probe_max_backoff, self.probe_backoff * 2 ** (attempts - 1))
+            delay *= random.uniform(0.5, 1.5)
+            self.next_probe_at = time.time() + delay
+            time.sleep(delay)
+            try:
+                with self._refresh_lock:
+                    self._load()
+                break
+            except Exception:
+                # Errore registrato da _load; si riprova dopo un'attesa più lunga
+                continue
+        with self._degraded_lock:
+            self.degraded_since = None
+            self._probing = False
+        if self.on_recover is not None:
+            try:
+                self.on_recover()
+            except Exception as e:
+                self.last_error = e
+
+    def book(self, new_rows: pd.DataFrame, write: Callable[[], None]) -> Snapshot:
+        """
+        Controllo duplicati e scrittura atomici: con i lock delle chiavi coinvolte
+        si verifica lo snapshot corrente (che include le scritture già fatte nel
+        processo), si chiama `write` (compare-and-append sul backend) e si
+        aggiorna lo snapshot prima di rilasciare i lock.
+        Solleva DuplicateBookingError se una chiave ha già una prenotazione attiva.
+        """
+        keys = BookingIndex.build(new_rows).keys
+        with self._booking_locks.hold(keys):
+            snap = self.get()
+            conflicts = keys & snap.booking_index.keys
+            if conflicts:
+                raise DuplicateBookingError(conflicts)
+            write()
+            return self.append_prenotazioni(new_rows)
+
+    def append_prenotazioni(self, new_rows: pd.DataFrame) -> Snapshot:
+        """
+        Aggiunge allo snapshot corrente righe appena scritte sul foglio, senza
+        rileggerlo. Il prossimo refresh le ritroverà nel delta del WorksheetSync.
+        """
+        with self._refresh_lock:
+            prev = self._snapshot
+            if prev is None:
+                return self._load()
+
+            start = len(prev.prenotazioni)
+            new_rows = apply_schema("prenotazioni", new_rows.set_axis(range(start, start + len(new_rows))))
+            snap = replace(
+                prev,
+                version=prev.version + 1,
+                prenotazioni=concat_frames("prenotazioni", [prev.prenotazioni, new_rows]),
+                booking_index=prev.booking_index.with_bookings(new_rows),
+                availability=prev.availability.with_bookings(new_rows),
+            )
+            self._snapshot = snap
+            # Lo snapshot non corrisponde più ai DataFrame del loader: il prossimo
+            # caricamento ripubblica le prenotazioni anche se il foglio non è cambiato
+            # (es. righe accodate in modalità degradata e poi scartate)
+            self._raw.pop("prenotazioni", None)
+            return snap
+
+    def update_prenotazioni(self, changes: Dict[int, Dict[str, str]], write: Callable[[], None]) -> Snapshot:
+        """
+        Modifica prenotazioni esistenti (posizione -> nuovi valori testuali, es.
+        evasione o restituzione): con i lock delle chiavi coinvolte si chiama
+        `write` e si aggiornano snapshot, indici e disponibilità senza rileggere
+        i fogli.
+        """
+        keys = BookingIndex.build(self.get().prenotazioni.loc[list(changes)]).keys
+        with self._booking_locks.hold(keys):
+            write()
+            with self._refresh_lock:
+                prev = self._snapshot
+                prenotazioni = prev.prenotazioni.copy()
+                # Righe raggruppate per colonne modificate: ogni riga riceve solo i
+                # propri valori (un DataFrame unico riempirebbe le altre con NaN)
+                groups: Dict[Tuple[str, ...], List[int]] = {}
+                for position, values in changes.items():
+                    groups.setdefault(tuple(values), []).append(position)
+                for cols, positions in groups.items():
+                    typed = normalize_prenotazioni(pd.DataFrame(
+                        [[changes[position][col] for col in cols] for position in positions],
+                        index=positions, columns=list(cols)))
+                    for col in cols:
+                        prenotazioni.loc[positions, col] = typed[col]
+                booking_index = prev.booking_index.with_updates(prenotazioni, list(changes))
+                snap = replace(
+                    prev,
+                    version=prev.version + 1,
+                    prenotazioni=prenotazioni,
+                    booking_index=booking_index,
+                    availability=prev.availability.with_returns(prev.booking_index.keys - booking_index.keys),
+                )
+                self._snapshot = snap
+                return snap
+
+    def _load(self) -> Snapshot:
+        try:
+            with METRICS.time("repository_load"):
+                database, prenotazioni, gestori = self.loader()
+            check_columns({"database": database, "prenotazioni": prenotazioni, "gestori": gestori})
+        except SchemaError as e:
+            # Dati da correggere, non un backend irraggiungibile: niente modalità degradata
+            self.last_error = e
+            raise
+        except Exception as e:
+            self.mark_degraded(e)
+            raise
+        self.last_error = None
+        prev_version = self.version
+        with METRICS.time("snapshot_publish"):
+            snap = self._publish(database=database, prenotazioni=prenotazioni, gestori=gestori)
+        if self.disk_cache is not None and snap.version != prev_version:
+            threading.Thread(target=self._persist, args=(snap,), daemon=True).start()
+        return snap
+
+    def _persist(self, snap: Snapshot):
+        try:
+            self.disk_cache.save(snap)
+        except Exception as e:
+            self.last_error = e
+
+    def _publish(self, database: pd.DataFrame, prenotazioni: pd.DataFrame,
+                 gestori: pd.DataFrame) -> Snapshot:
+        """
+        Pubblica i nuovi DataFrame. Tipizzazione (schema.py), indici e report di
+        memoria si ricalcolano solo per i fogli effettivamente cambiati: i
+        Repository restituiscono lo stesso oggetto se il foglio non è cambiato.
+        """
+        prev = self._snapshot
+        now = time.time()
+        raw = {"database": database, "prenotazioni": prenotazioni, "gestori": gestori}
+        changed = {name for name, frame in raw.items() if frame is not self._raw.get(name)}
+        if prev is not None and not changed:
+            snap = replace(prev, loaded_at=now)
+        else:
+            frames = {name: apply_schema(name, frame) if name in changed or prev is None else getattr(prev, name)
+                      for name, frame in raw.items()}
+            memory = dict(prev.memory_report) if prev is not None else {}
+            for name in changed:
+                memory[name] = (frame_memory(raw[name]), frame_memory(frames[name]))
+
+            def derive(field: str, source: str, build):
+                if prev is not None and source not in changed:
+                    return getattr(prev, field)
+                return build(frames[source])
+
+            booking_index = derive('booking_index', 'prenotazioni', BookingIndex.build)
+            if prev is not None and not changed & {'database', 'prenotazioni'}:
+                availability = prev.availability
+            else:
+                availability = AvailabilityIndex.build(frames['database'], booking_index)
+
+            snap = Snapshot(
+                version=prev.version + 1 if prev is not None else 1,
+                loaded_at=now,
+                portfolio_index=derive('portfolio_index', 'database', PortfolioIndex.build),
+                search_index=derive('search_index', 'database', SearchIndex.build),
+                booking_index=booking_index,
+                availability=availability,
+                memory_report=memory,
+                **frames,
+            )
+        self._raw = raw
+        self._snapshot = snap
+        return snap
@@ -0,0 +1,1171 @@
+"""
+Backend di persistenza intercambiabili.
+
+Ogni Repository espone gli stessi tre fogli (database, prenotazioni, gestori)
+come intestazione + righe di stringhe, nello stesso formato di Google Sheets
+(date DD/MM/YYYY, booleani TRUE/FALSE), e l'append di nuove prenotazioni.
+Le prenotazioni restituite da tempo si possono spostare nel foglio
+`archivio_prenotazioni` dello stesso backend (vedi archive.py), così il
+foglio prenotazioni letto a ogni refresh resta piccolo.
+
+- GoogleSheetsRepository: fogli Google, letti in modo incrementale (WorksheetSync).
+- ExcelRepository: file Excel locale (dati/db_fascicoli.xlsx), come le vecchie versioni.
+- SQLiteRepository: database locale indicizzato, utilizzabile anche offline.
+- WriteBehindRepository: coda di scrittura durevole e asincrona davanti a un altro backend.
+- MirroredRepository: SQLite come archivio primario e Google Sheets come
+  copia aggiornata in modo asincrono.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+from gspread.utils import absolute_range_name, numericise_all, rowcol_to_a1
+
+from indexes import BookingIndex, BookingKey, DuplicateBookingError
+from lazy_database import MAX_PORTAFOGLI, LazyDatabase
+from metrics import METRICS
+from schema import PRENOTAZIONI_COLUMNS
+from sheets import FULL_RELOAD_SECONDS, WorksheetSync, column_letter, sync_batch, to_frame, update_digest
+
+
+SHEET_NAMES = ("database", "prenotazioni", "gestori")
+
+# Foglio (o tabella) con lo storico delle prenotazioni archiviate
+ARCHIVE_SHEET = "archivio_prenotazioni"
+
+# NOTE delle prenotazioni annullate perché scritte in concorrenza da più istanze
+DUPLICATE_NOTE = "ANNULLATA: prenotazione duplicata"
+
+# Righe scartate dalla coda di scrittura e mai reclamate dalla sessione che le ha inviate
+REJECTED_TTL = 24 * 3600
+
+SheetRows = Tuple[List[str], List[List[str]]]
+Normalizer = Optional[Callable[[pd.DataFrame], pd.DataFrame]]
+
+# Modifica di una prenotazione esistente: posizione della riga (0 = prima riga
+# dopo l'intestazione), chiave attesa in quella riga, nuovi valori per colonna
+BookingUpdate = Tuple[int, BookingKey, Dict[str, str]]
+
+
+class StaleBookingError(Exception):
+    """La riga indicata non contiene (più) la prenotazione attesa."""
+
+    def __init__(self, position: int, key: BookingKey):
+        self.position = position
+        self.key = key
+        super().__init__(f"Riga {position + 2} del foglio prenotazioni: prenotazione {key} non trovata")
+
+
+def _row_key(header: List[str], row: List[str]) -> BookingKey:
+    """Chiave di una riga testuale, con la stessa conversione numerica dei DataFrame."""
+    values = dict(zip(header, numericise_all(list(row), False, "", False, None)))
+    return tuple(str(values.get(col, '')) for col in ('NDG', 'PORTAFOGLIO', 'MOTIVAZIONE_RICHIESTA'))
+
+
+def _align_rows(header: List[str], rows: List[List[str]]) -> List[List[str]]:
+    """
+    Righe nuove, nell'ordine di PRENOTAZIONI_COLUMNS -> righe nell'ordine
+    dell'intestazione del foglio (le colonne assenti dalle righe restano vuote).
+    """
+    return [[values.get(col, '') for col in header]
+            for values in (dict(zip(PRENOTAZIONI_COLUMNS, row)) for row in rows)]
+
+
+def _row_id(row: List[str]) -> Tuple[str, ...]:
+    """Identità di una riga nuova tra coda, journal e sessione (i valori passano da JSON)."""
+    return tuple(str(v) for v in row)
+
+
+def _key_text(value) -> str:
+    """Valore di una colonna della chiave come nei DataFrame (stessa conversione numerica di to_frame)."""
+    return str(numericise_all(['' if value is None else str(value)], False, "", False, None)[0])
+
+
+def _new_row_key(row: List[str]) -> BookingKey:
+    """Chiave di una riga nuova (nell'ordine di PRENOTAZIONI_COLUMNS)."""
+    return _row_key(PRENOTAZIONI_COLUMNS, row)
+
+
+def _updated_row(header: List[str], row: Optional[List[str]], position: int,
+                 key: BookingKey, values: Dict[str, str]) -> List[str]:
+    """Riga con i nuovi valori, dopo aver verificato che contenga la prenotazione attesa."""
+    if row is None or _row_key(header, row) != key:
+        raise StaleBookingError(position, key)
+    row = list(row) + [''] * (len(header) - len(row))
+    for col, value in values.items():
+        row[header.index(col)] = value
+    return row
+
+
+def _archivable_positions(header: List[str], rows: List[List[str]], cutoff: date, limit: int) -> List[int]:
+    """
+    Posizioni delle prenotazioni restituite prima di `cutoff` (data di
+    restituzione, o di richiesta se manca), al massimo `limit`.
+    """
+    if not rows or 'RESTITUITO' not in header:
+        return []
+    frame = pd.DataFrame(rows, columns=header)
+
+    def parse(col: str) -> pd.Series:
+        if col not in frame.columns:
+            return pd.Series(pd.NaT, index=frame.index)
+        return pd.to_datetime(frame[col], format='%d/%m/%Y', errors='coerce')
+
+    returned = frame['RESTITUITO'].astype(str).str.upper() == 'TRUE'
+    returned_at = parse('DATA_RESTITUZIONE').fillna(parse('DATA_RICHIESTA'))
+    mask = returned & (returned_at < pd.Timestamp(cutoff))
+    return [int(p) for p in mask.to_numpy().nonzero()[0][:limit]]
+
+
+def _first_appended_row(response) -> Optional[int]:
+    """Numero della prima riga scritta da un append, da updatedRange (es. "prenotazioni!A12:M13")."""
+    match = re.search(r"![A-Z]+(\d+)", ((response or {}).get("updates") or {}).get("updatedRange", ""))
+    return int(match.group(1)) if match else None
+
+
+def _row_runs(positions: List[int]) -> List[Tuple[int, int]]:
+    """Posizioni ordinate -> intervalli contigui [inizio, fine), dall'ultimo al primo."""
+    runs: List[List[int]] = []
+    for pos in sorted(positions):
+        if runs and runs[-1][1] == pos:
+            runs[-1][1] = pos + 1
+        else:
+            runs.append([pos, pos + 1])
+    return [(start, end) for start, end in reversed(runs)]
+
+
+class Repository(ABC):
+    """Interfaccia comune dei backend."""
+
+    def __init__(self, normalize: Normalizer = None):
+        # Normalizzazione (booleani, date) applicata al foglio prenotazioni
+        self.normalize = normalize
+
+    @abstractmethod
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        """Intestazione e righe (stringhe) di ciascun foglio."""
+
+    @abstractmethod
+    def append_prenotazioni(self, rows: List[List[str]]):
+        """
+        Aggiunge righe al foglio prenotazioni. Le righe sono nell'ordine di
+        PRENOTAZIONI_COLUMNS e vanno scritte secondo l'intestazione del foglio.
+        """
+
+    @abstractmethod
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        """
+        Modifica celle di prenotazioni esistenti (es. evasione, restituzione).
+        Solleva StaleBookingError, senza scrivere nulla, se una riga non
+        contiene la prenotazione attesa.
+        """
+
+    @abstractmethod
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        """
+        Sposta nel foglio ARCHIVE_SHEET al più `limit` prenotazioni restituite
+        prima di `cutoff` (prima l'append nell'archivio, poi la rimozione: in
+        caso di errore tra le due una riga può trovarsi in entrambi, mai in
+        nessuno). Restituisce il numero di righe spostate.
+        """
+
+    @abstractmethod
+    def read_archivio(self) -> pd.DataFrame:
+        """Prenotazioni archiviate, normalizzate come il foglio prenotazioni."""
+
+    def write_status(self) -> Optional["WriteStatus"]:
+        """Stato della coda di scrittura asincrona, se presente."""
+        return None
+
+    def queue_outcome(self, rows: List[List[str]]) -> Tuple[List[List[str]], List[List[str]]]:
+        """
+        Esito nella coda asincrona delle righe inviate da una sessione: (scartate,
+        ancora in attesa). Le scartate si restituiscono una sola volta.
+        """
+        return [], []
+
+    def load_portafogli(self, portafogli: Iterable[str]) -> bool:
+        """
+        Caricamento pigro del database: garantisce che le righe dei portafogli
+        indicati siano nel prossimo load. True se il database è cambiato. I
+        backend che caricano tutto il foglio non devono fare nulla.
+        """
+        return False
+
+    def prenotazioni_header(self) -> List[str]:
+        return self.read_sheets()["prenotazioni"][0]
+
+    def active_booking_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        """Chiavi che hanno già una prenotazione attiva nel backend."""
+        _, prenotazioni, _ = self.load()
+        return keys & BookingIndex.build(prenotazioni).keys
+
+    def append_prenotazioni_if_absent(self, rows: List[List[str]], keys: Set[BookingKey]):
+        """
+        Compare-and-append: ricontrolla sul backend che nessuna chiave abbia già
+        una prenotazione attiva (DuplicateBookingError) e poi scrive.
+        """
+        conflicts = self.active_booking_conflicts(keys)
+        if conflicts:
+            raise DuplicateBookingError(conflicts)
+        self.append_prenotazioni(rows)
+
+    def _split_conflicts(self, rows: List[List[str]]) -> Tuple[List[List[str]], List[List[str]]]:
+        """(righe da scrivere, righe la cui chiave è già attiva nel backend o nel lotto)."""
+        row_keys = [_new_row_key(row) for row in rows]
+        conflicts = self.active_booking_conflicts(set(row_keys))
+        accepted, rejected, seen = [], [], set()
+        for row, key in zip(rows, row_keys):
+            if key in conflicts or key in seen:
+                rejected.append(row)
+            else:
+                accepted.append(row)
+                seen.add(key)
+        return accepted, rejected
+
+    def append_prenotazioni_unique(self, rows: List[List[str]]) -> List[List[str]]:
+        """
+        Compare-and-append riga per riga (per le code di scrittura): scrive solo
+        le righe senza prenotazione attiva nel backend e restituisce le scartate.
+        """
+        accepted, rejected = self._split_conflicts(rows)
+        if accepted:
+            self.append_prenotazioni(accepted)
+        return rejected
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        sheets = self.read_sheets()
+        dfs = {
+            name: to_frame(*sheets[name], self.normalize if name == "prenotazioni" else None)
+            for name in SHEET_NAMES
+        }
+        return dfs['database'], dfs['prenotazioni'], dfs['gestori']
+
+
+class GoogleSheetsRepository(Repository):
+    """
+    Fogli Google. Il foglio prenotazioni è append-only: a ogni load si
+    scaricano solo le righe nuove. Gli handle dei worksheet si ottengono una
+    volta sola (una chiamata di metadati) e ogni load è una sola richiesta
+    values_batch_get per i tre fogli.
+
+    Prima di leggere i valori si chiede a Drive il modifiedTime dello
+    spreadsheet: se non è cambiato dall'ultima lettura si riusano i DataFrame
+    già in memoria (stessi oggetti, quindi lo snapshot non si ricalcola) e il
+    refresh costa una sola piccola chiamata di metadati. Ogni
+    FULL_RELOAD_SECONDS si rilegge comunque, nel caso il modifiedTime arrivi
+    in ritardo rispetto a una modifica.
+
+    Con lazy_database=True il foglio database non si legge per intero: load
+    restituisce solo i portafogli richiesti con load_portafogli (vedi
+    lazy_database.py), più l'elenco completo in attrs.
+    """
+
+    def __init__(self, spreadsheet, normalize: Normalizer = None, lazy_database: bool = False,
+                 max_portafogli: int = MAX_PORTAFOGLI):
+        super().__init__(normalize)
+        self.spreadsheet = spreadsheet
+        self._worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+        self.syncs = {
+            "prenotazioni": WorksheetSync(self._worksheets["prenotazioni"], append_only=True,
+                                          normalize=normalize),
+            "gestori": WorksheetSync(self._worksheets["gestori"]),
+        }
+        self.lazy: Optional[LazyDatabase] = None
+        if lazy_database:
+            self.lazy = LazyDatabase(spreadsheet, self._worksheets["database"], max_portafogli)
+        else:
+            self.syncs["database"] = WorksheetSync(self._worksheets["database"])
+        self._booking_index: Tuple[Optional[pd.DataFrame], Optional[BookingIndex]] = (None, None)
+        # modifiedTime letto prima dell'ultima sincronizzazione completata
+        self._synced_marker: Optional[str] = None
+        self._synced_at = 0.0
+        self.last_marker_error: Optional[Exception] = None
+        self.last_reconcile_error: Optional[Exception] = None
+        # Aggiornamenti, riconciliazione e archiviazione individuano le righe per
+        # posizione e l'archiviazione le sposta: non devono sovrapporsi
+        self._write_lock = threading.RLock()
+
+    def change_marker(self) -> Optional[str]:
+        """modifiedTime dello spreadsheet (Drive API), None se non disponibile."""
+        try:
+            with METRICS.time("change_marker"):
+                marker = self.spreadsheet.get_lastUpdateTime()
+        except Exception as e:
+            # Es. Drive API non abilitata: si legge sempre, come senza marcatore
+            self.last_marker_error = e
+            return None
+        self.last_marker_error = None
+        return marker
+
+    def _sync_all(self):
+        """Sincronizza i tre fogli, salvo che lo spreadsheet non risulti invariato."""
+        marker = self.change_marker()
+        if (marker is not None and marker == self._synced_marker
+                and time.time() - self._synced_at < FULL_RELOAD_SECONDS):
+            return
+        # Il marcatore è letto prima dei valori: una modifica concorrente
+        # cambia il modifiedTime e viene letta al refresh successivo
+        sync_batch(self.spreadsheet, list(self.syncs.values()))
+        self._synced_marker = marker
+        self._synced_at = time.time()
+
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        self._sync_all()
+        sheets = {name: (list(sync.header), list(sync.rows)) for name, sync in self.syncs.items()}
+        if self.lazy is not None:
+            # Solo le righe dei portafogli in memoria
+            database = self.lazy.frame()
+            sheets["database"] = (list(database.columns), database.astype(str).values.tolist())
+        return sheets
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        # # RIMUOVI TUTTI I FILTRI PRIMA DI LEGGERE
+        # for name, sync in self.syncs.items():
+        #     force_remove_all_filters(sync.worksheet)
+        self._sync_all()
+        dfs = {name: sync.frame for name, sync in self.syncs.items()}
+        if self.lazy is not None:
+            dfs['database'] = self.lazy.frame()
+        return dfs['database'], dfs['prenotazioni'], dfs['gestori']
+
+    def load_portafogli(self, portafogli: Iterable[str]) -> bool:
+        if self.lazy is None:
+            return False
+        return self.lazy.load(portafogli)
+
+    def prenotazioni_header(self) -> List[str]:
+        sync = self.syncs["prenotazioni"]
+        if not sync.header:
+            sync.sync()
+        return list(sync.header)
+
+    def active_booking_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        """
+        Confronto sul numero di righe: il sync rilegge solo le righe aggiunte dopo
+        l'ultima lettura (una chiamata piccola) e l'indice si ricostruisce solo se
+        il foglio è cambiato. Google Sheets non ha transazioni: tra questo
+        controllo e l'append resta la finestra di una singola richiesta, che
+        tra istanze diverse dell'app può produrre un duplicato: la chiude
+        append_prenotazioni_unique, usata dalla coda di WriteBehindRepository.
+        """
+        frame = self.syncs["prenotazioni"].sync()
+        cached_frame, index = self._booking_index
+        if frame is not cached_frame:
+            index = BookingIndex.build(frame)
+            self._booking_index = (frame, index)
+        return keys & index.keys
+
+    def append_prenotazioni(self, rows: List[List[str]]):
+        # # RIMUOVI TUTTI I FILTRI PRIMA DI SALVARE
+        # force_remove_all_filters(self.syncs["prenotazioni"].worksheet)
+
+        # Append lato server: la tabella è quella di dati contigui da A1, quindi una
+        # riga vuota (prenotazione cancellata a mano) la chiude prima della fine.
+        # INSERT_ROWS inserisce righe nuove invece di sovrascrivere quelle dopo il vuoto
+        sync = self.syncs["prenotazioni"]
+        if not sync.header:
+            sync.sync()
+        expected_row = len(sync.rows) + 2
+        response = sync.worksheet.append_rows(
+            _align_rows(sync.header, rows), value_input_option="USER_ENTERED",
+            insert_data_option="INSERT_ROWS", table_range="A1"
+        )
+        first_row = _first_appended_row(response)
+        if first_row is None or first_row < expected_row:
+            # Righe inserite prima della fine nota del foglio (vuoto nella tabella o
+            # righe archiviate da un'altra istanza): le posizioni successive sono
+            # cambiate e il delta non le vedrebbe, si ricarica tutto
+            sync.invalidate()
+            self._synced_marker = None
+            self._booking_index = (None, None)
+        return first_row
+
+    def append_prenotazioni_unique(self, rows: List[List[str]]) -> List[List[str]]:
+        """
+        Come Repository.append_prenotazioni_unique, con una riconciliazione dopo
+        l'append: tra controllo e append un'altra istanza può aver scritto la
+        stessa chiave. Si rilegge il delta e per ogni chiave vale la riga attiva
+        più in alto: le righe appena scritte precedute da un'altra riga attiva
+        con la stessa chiave si annullano (RESTITUITO=TRUE) e risultano scartate.
+        Ogni istanza applica la stessa regola, quindi ne resta attiva una sola.
+        """
+        with self._write_lock:
+            accepted, rejected = self._split_conflicts(rows)
+            if not accepted:
+                return rejected
+            first_row = self.append_prenotazioni(accepted)
+            if first_row is None:
+                return rejected
+
+            try:
+                sync = self.syncs["prenotazioni"]
+                frame = sync.sync()
+                active = frame[~frame['RESTITUITO'].astype(bool)]
+                first: Dict[BookingKey, int] = {}
+                for position, key in zip(active.index, zip(active['NDG'].astype(str), active['PORTAFOGLIO'].astype(str),
+                                                           active['MOTIVAZIONE_RICHIESTA'].astype(str))):
+                    first.setdefault(key, position)
+                updates = []
+                for offset, row in enumerate(accepted):
+                    position = first_row - 2 + offset
+                    key = _new_row_key(row)
+                    if first.get(key, position) < position:
+                        updates.append((position, key, {'RESTITUITO': 'TRUE', 'NOTE': DUPLICATE_NOTE}))
+                        rejected.append(row)
+                if updates:
+                    self.update_prenotazioni(updates)
+            except Exception as e:
+                # Le righe sono già scritte: l'errore non deve far ripetere l'append
+                self.last_reconcile_error = e
+            return rejected
+
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        """
+        Tutte le celle modificate in un'unica batch_update. Le righe si trovano
+        per posizione (solo archive_prenotazioni le sposta, sotto lo stesso lock)
+        e si verificano sullo snapshot appena sincronizzato; lo snapshot del
+        foglio viene poi aggiornato sul posto, senza rileggerlo.
+        """
+        with self._write_lock:
+            sync = self.syncs["prenotazioni"]
+            sync.sync()
+            header = sync.header
+            rows: Dict[int, List[str]] = {}
+            data = []
+            for position, key, values in updates:
+                current = rows.get(position) or (sync.rows[position] if position < len(sync.rows) else None)
+                rows[position] = _updated_row(header, current, position, key, values)
+                for col, value in values.items():
+                    data.append({"range": rowcol_to_a1(position + 2, header.index(col) + 1), "values": [[value]]})
+            if not data:
+                return
+            sync.worksheet.batch_update(data, value_input_option="USER_ENTERED")
+            sync.apply_updates(rows)
+            self._booking_index = (None, None)
+
+    def _archive_worksheet(self):
+        worksheet = self._worksheets.get(ARCHIVE_SHEET)
+        if worksheet is None:
+            # Potrebbe essere stato creato da un'altra istanza: si rileggono gli handle
+            self._worksheets = {ws.title: ws for ws in self.spreadsheet.worksheets()}
+            worksheet = self._worksheets.get(ARCHIVE_SHEET)
+        return worksheet
+
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        """
+        Un append_rows sull'archivio e una sola batch_update con le
+        deleteDimension degli intervalli di righe, dall'ultimo al primo così
+        che gli indici restino validi. Le righe si scelgono sul foglio appena
+        sincronizzato; la sincronizzazione successiva sarà completa.
+
+        Il lock copre solo questo processo: subito prima della cancellazione le
+        righe si rileggono (una values_batch_get) e si confrontano con quelle
+        attese. Se una non corrisponde (spostata da un'altra istanza o da una
+        modifica manuale) si annulla la copia nell'archivio, non si cancella
+        nulla e si solleva StaleBookingError.
+        """
+        with self._write_lock:
+            sync = self.syncs["prenotazioni"]
+            sync.sync()
+            header = list(sync.header)
+            positions = _archivable_positions(header, sync.rows, cutoff, limit)
+            if not positions:
+                return 0
+
+            rows = [list(sync.rows[pos]) for pos in positions]
+            expected = {pos: _row_key(header, sync.rows[pos]) for pos in positions}
+            archive = self._archive_worksheet()
+            header_rows = 0
+            if archive is None:
+                archive = self.spreadsheet.add_worksheet(ARCHIVE_SHEET, rows=1, cols=len(header))
+                self._worksheets[ARCHIVE_SHEET] = archive
+                rows = [header] + rows
+                header_rows = 1
+            response = archive.append_rows(rows, value_input_option="USER_ENTERED", table_range="A1")
+
+            try:
+                runs = _row_runs(positions)
+                stale = self._archive_mismatch(header, runs, expected)
+                if stale is not None:
+                    first_row = _first_appended_row(response)
+                    if first_row is not None:
+                        # Righe appena copiate nell'archivio: altrimenti il prossimo giro le duplica
+                        start = first_row - 1 + header_rows
+                        self.spreadsheet.batch_update({"requests": [
+                            {"deleteDimension": {"range": {"sheetId": archive.id, "dimension": "ROWS",
+                                                           "startIndex": start, "endIndex": start + len(positions)}}}
+                        ]})
+                    raise StaleBookingError(stale, expected[stale])
+
+                self.spreadsheet.batch_update({"requests": [
+                    {"deleteDimension": {"range": {"sheetId": sync.worksheet.id, "dimension": "ROWS",
+                                                   "startIndex": start + 1, "endIndex": end + 1}}}
+                    for start, end in runs
+                ]})
+            finally:
+                # Anche dopo un errore la cancellazione potrebbe essere avvenuta: si rilegge tutto
+                sync.invalidate()
+                self._synced_marker = None
+                self._booking_index = (None, None)
+            return len(positions)
+
+    def _archive_mismatch(self, header: List[str], runs: List[Tuple[int, int]],
+                          expected: Dict[int, BookingKey]) -> Optional[int]:
+        """Rilegge gli intervalli `runs`; prima posizione che non contiene più la riga restituita attesa."""
+        title = self.syncs["prenotazioni"].worksheet.title
+        last_col = column_letter(len(header))
+        response = self.spreadsheet.values_batch_get(
+            [absolute_range_name(title, f"A{start + 2}:{last_col}{end + 1}") for start, end in runs])
+        for (start, end), value_range in zip(runs, response.get("valueRanges", [])):
+            values = value_range.get("values", [])
+            for position in range(start, end):
+                row = values[position - start] if position - start < len(values) else []
+                returned = dict(zip(header, row)).get('RESTITUITO', '')
+                if _row_key(header, row) != expected[position] or str(returned).upper() != 'TRUE':
+                    return position
+        return None
+
+    def read_archivio(self) -> pd.DataFrame:
+        archive = self._archive_worksheet()
+        values = archive.get_all_values() if archive is not None else []
+        if not values:
+            return pd.DataFrame()
+        return to_frame(values[0], values[1:], self.normalize)
+
+
+def _cell_to_str(value) -> str:
+    """Converte una cella Excel nel formato testuale di Google Sheets."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%d/%m/%Y')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class ExcelRepository(Repository):
+    """
+    File Excel locale con un foglio per tabella (vedi old/backup.py). Come
+    marcatore di modifica si usa la data di modifica del file: se non è
+    cambiata, load restituisce gli stessi DataFrame senza riaprire il file.
+    """
+
+    def __init__(self, path: str, normalize: Normalizer = None):
+        super().__init__(normalize)
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded: Tuple[Optional[tuple], Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]] = (None, None)
+
+    def change_marker(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        marker = self.change_marker()
+        cached_marker, frames = self._loaded
+        if marker is not None and marker == cached_marker:
+            return frames
+        frames = super().load()
+        self._loaded = (marker, frames)
+        return frames
+
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        from openpyxl import load_workbook
+
+        with self._lock:
+            wb = load_workbook(self.path, read_only=True, data_only=True)
+            try:
+                sheets = {}
+                for name in SHEET_NAMES:
+                    if name not in wb.sheetnames:
+                        sheets[name] = ([], [])
+                        continue
+                    values = [[_cell_to_str(v) for v in row] for row in wb[name].iter_rows(values_only=True)]
+                    header = values[0] if values else []
+                    while header and header[-1] == '':
+                        header.pop()
+                    rows = [row[:len(header)] for row in values[1:] if any(row)]
+                    sheets[name] = (header, rows)
+                return sheets
+            finally:
+                wb.close()
+
+    def append_prenotazioni(self, rows: List[List[str]]):
+        from openpyxl import load_workbook
+
+        with self._lock:
+            wb = load_workbook(self.path)
+            ws = wb["prenotazioni"]
+            header = [_cell_to_str(cell.value) for cell in ws[1]]
+            for row in _align_rows(header, rows):
+                ws.append(row)
+            wb.save(self.path)
+
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        from openpyxl import load_workbook
+
+        with self._lock:
+            wb = load_workbook(self.path)
+            ws = wb["prenotazioni"]
+            header = [_cell_to_str(cell.value) for cell in ws[1]]
+            while header and header[-1] == '':
+                header.pop()
+            new_rows = {}
+            for position, key, values in updates:
+                current = new_rows.get(position) or [_cell_to_str(cell.value) for cell in ws[position + 2]]
+                new_rows[position] = _updated_row(header, current[:len(header)], position, key, values)
+            for position, row in new_rows.items():
+                for col, value in enumerate(row, start=1):
+                    ws.cell(row=position + 2, column=col, value=value)
+            wb.save(self.path)
+
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        from openpyxl import load_workbook
+
+        with self._lock:
+            wb = load_workbook(self.path)
+            ws = wb["prenotazioni"]
+            values = [[_cell_to_str(v) for v in row] for row in ws.iter_rows(values_only=True)]
+            header = values[0] if values else []
+            while header and header[-1] == '':
+                header.pop()
+            rows = [row[:len(header)] for row in values[1:]]
+            positions = _archivable_positions(header, rows, cutoff, limit)
+            if not positions:
+                return 0
+            if ARCHIVE_SHEET not in wb.sheetnames:
+                wb.create_sheet(ARCHIVE_SHEET).append(header)
+            for pos in positions:
+                wb[ARCHIVE_SHEET].append(rows[pos])
+            for start, end in _row_runs(positions):
+                ws.delete_rows(start + 2, end - start)
+            wb.save(self.path)
+            return len(positions)
+
+    def read_archivio(self) -> pd.DataFrame:
+        from openpyxl import load_workbook
+
+        with self._lock:
+            wb = load_workbook(self.path, read_only=True, data_only=True)
+            try:
+                if ARCHIVE_SHEET not in wb.sheetnames:
+                    return pd.DataFrame()
+                values = [[_cell_to_str(v) for v in row] for row in wb[ARCHIVE_SHEET].iter_rows(values_only=True)]
+            finally:
+                wb.close()
+        if not values:
+            return pd.DataFrame()
+        header = values[0]
+        while header and header[-1] == '':
+            header.pop()
+        return to_frame(header, [row[:len(header)] for row in values[1:] if any(row)], self.normalize)
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Chiave delle prenotazioni e condizione "non restituita" per query e indice parziale di SQLite
+_ACTIVE_KEY_COLUMNS = "key_text(NDG), key_text(PORTAFOGLIO), key_text(MOTIVAZIONE_RICHIESTA)"
+_ACTIVE_CONDITION = "upper(coalesce(RESTITUITO, '')) <> 'TRUE'"
+
+
+class SQLiteRepository(Repository):
+    """
+    Database SQLite locale: una tabella per foglio, colonne TEXT come
+    l'intestazione del foglio, indici su NDG, PORTAFOGLIO e sulla chiave
+    delle prenotazioni attive. I valori restano quelli del foglio: la chiave
+    si confronta con la funzione SQL key_text (la conversione numerica dei
+    DataFrame, "0123" = "123") e RESTITUITO senza distinguere maiuscole,
+    come BookingIndex.
+    """
+
+    def __init__(self, path: str, normalize: Normalizer = None):
+        super().__init__(normalize)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.create_function("key_text", 1, _key_text, deterministic=True)
+        self._lock = threading.RLock()
+        # Contatore di modifiche per tabella: load() ricostruisce solo i DataFrame cambiati
+        self._changes: Dict[str, int] = {name: 0 for name in SHEET_NAMES}
+        self._frames: Dict[str, Tuple[int, pd.DataFrame]] = {}
+        header = self._header("prenotazioni")
+        if header:
+            # File creati con l'indice precedente, sui valori grezzi
+            with self._conn:
+                self._create_indexes("prenotazioni", header)
+
+    def _header(self, name: str) -> List[str]:
+        columns = self._conn.execute(f"PRAGMA table_info({_quote(name)})").fetchall()
+        return [c[1] for c in columns if c[1] != '_row']
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._header("prenotazioni")
+
+    def replace_sheet(self, name: str, header: List[str], rows: List[List[str]]):
+        """Sostituisce il contenuto di una tabella (es. import da Google Sheets)."""
+        with self._lock, self._conn:
+            table = _quote(name)
+            columns = ", ".join(f"{_quote(h)} TEXT" for h in header)
+            self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.execute(f"CREATE TABLE {table} (_row INTEGER PRIMARY KEY{', ' if header else ''}{columns})")
+            if header:
+                placeholders = ", ".join("?" * len(header))
+                self._conn.executemany(
+                    f"INSERT INTO {table} ({', '.join(_quote(h) for h in header)}) VALUES ({placeholders})",
+                    rows,
+                )
+            self._create_indexes(name, header)
+            self._changes[name] += 1
+
+    def _create_indexes(self, name: str, header: List[str]):
+        table = _quote(name)
+        for column in ("NDG", "PORTAFOGLIO"):
+            if column in header:
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {_quote(f'idx_{name}_{column}')} ON {table} ({_quote(column)})"
+                )
+        booking_key = ("NDG", "PORTAFOGLIO", "MOTIVAZIONE_RICHIESTA", "RESTITUITO")
+        if name == "prenotazioni" and all(c in header for c in booking_key):
+            self._conn.execute("DROP INDEX IF EXISTS idx_prenotazioni_attive")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_prenotazioni_chiavi_attive "
+                f"ON prenotazioni ({_ACTIVE_KEY_COLUMNS}) WHERE {_ACTIVE_CONDITION}"
+            )
+
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        with self._lock:
+            return {name: self._read(name) for name in SHEET_NAMES}
+
+    def _read(self, name: str) -> SheetRows:
+        header = self._header(name)
+        if not header:
+            return [], []
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(_quote(h) for h in header)} FROM {_quote(name)} ORDER BY _row"
+        )
+        return header, [["" if v is None else v for v in row] for row in cursor]
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        dfs = {}
+        with self._lock:
+            for name in SHEET_NAMES:
+                cached = self._frames.get(name)
+                if cached is None or cached[0] != self._changes[name]:
+                    normalize = self.normalize if name == "prenotazioni" else None
+                    cached = (self._changes[name], to_frame(*self._read(name), normalize))
+                    self._frames[name] = cached
+                dfs[name] = cached[1]
+        return dfs['database'], dfs['prenotazioni'], dfs['gestori']
+
+    def prenotazioni_header(self) -> List[str]:
+        with self._lock:
+            return self._header("prenotazioni")
+
+    def _insert_prenotazioni(self, rows: List[List[str]]):
+        header = self._header("prenotazioni")
+        placeholders = ", ".join("?" * len(header))
+        self._conn.executemany(
+            f"INSERT INTO prenotazioni ({', '.join(_quote(h) for h in header)}) VALUES ({placeholders})",
+            _align_rows(header, rows),
+        )
+        self._changes["prenotazioni"] += 1
+
+    def append_prenotazioni(self, rows: List[List[str]]):
+        with self._lock, self._conn:
+            self._insert_prenotazioni(rows)
+
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        with self._lock, self._conn:
+            header = self._header("prenotazioni")
+            columns = ", ".join(_quote(h) for h in header)
+            row_ids = [r for (r,) in self._conn.execute("SELECT _row FROM prenotazioni ORDER BY _row")]
+            for position, key, values in updates:
+                current = None
+                if position < len(row_ids):
+                    found = self._conn.execute(f"SELECT {columns} FROM prenotazioni WHERE _row = ?",
+                                               (row_ids[position],)).fetchone()
+                    current = ["" if v is None else v for v in found]
+                _updated_row(header, current, position, key, values)
+                assignments = ", ".join(f"{_quote(col)} = ?" for col in values)
+                self._conn.execute(f"UPDATE prenotazioni SET {assignments} WHERE _row = ?",
+                                   [*values.values(), row_ids[position]])
+            self._changes["prenotazioni"] += 1
+
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        """Copia nella tabella di archivio e rimozione nella stessa transazione."""
+        with self._lock, self._conn:
+            header, rows = self._read("prenotazioni")
+            positions = _archivable_positions(header, rows, cutoff, limit)
+            if not positions:
+                return 0
+            row_ids = [r for (r,) in self._conn.execute("SELECT _row FROM prenotazioni ORDER BY _row")]
+            selected = [(row_ids[pos],) for pos in positions]
+            columns = ", ".join(_quote(h) for h in header)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {_quote(ARCHIVE_SHEET)} "
+                f"(_row INTEGER PRIMARY KEY, {', '.join(f'{_quote(h)} TEXT' for h in header)})"
+            )
+            self._conn.executemany(
+                f"INSERT INTO {_quote(ARCHIVE_SHEET)} ({columns}) SELECT {columns} FROM prenotazioni WHERE _row = ?",
+                selected,
+            )
+            self._conn.executemany("DELETE FROM prenotazioni WHERE _row = ?", selected)
+            self._changes["prenotazioni"] += 1
+            return len(positions)
+
+    def read_archivio(self) -> pd.DataFrame:
+        with self._lock:
+            header, rows = self._read(ARCHIVE_SHEET)
+        if not header:
+            return pd.DataFrame()
+        return to_frame(header, rows, self.normalize)
+
+    def has_active_booking(self, ndg, portafoglio, motivazione) -> bool:
+        """Lookup sull'indice parziale delle prenotazioni non restituite."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT 1 FROM prenotazioni WHERE ({_ACTIVE_KEY_COLUMNS}) = (?, ?, ?) "
+                f"AND {_ACTIVE_CONDITION} LIMIT 1",
+                (str(ndg), str(portafoglio), str(motivazione)),
+            ).fetchone()
+            return row is not None
+
+    def active_booking_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        return {key for key in keys if self.has_active_booking(*key)}
+
+    def append_prenotazioni_if_absent(self, rows: List[List[str]], keys: Set[BookingKey]):
+        """
+        Controllo e inserimento nella stessa transazione BEGIN IMMEDIATE:
+        atomici anche tra processi diversi che condividono il file.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                conflicts = self.active_booking_conflicts(keys)
+                if conflicts:
+                    raise DuplicateBookingError(conflicts)
+                self._insert_prenotazioni(rows)
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+
+@dataclass
+class WriteStatus:
+    """Stato della coda di scrittura, mostrato nella sidebar."""
+    pending: int
+    last_flush: float
+    last_error: Optional[Exception]
+    retry_at: float
+
+
+class WriteBehindRepository(Repository):
+    """
+    Coda di scrittura in background davanti a un altro Repository.
+
+    Le prenotazioni sono accettate subito: annotate in un journal JSONL locale
+    (sopravvive ai riavvii) e inviate al target da un thread worker, che
+    raccoglie quelle arrivate nello stesso intervallo e le scrive con un'unica
+    chiamata (append_rows). In caso di errore (es. quota API) si riprova con
+    backoff esponenziale con jitter. Finché non sono inviate, le righe in
+    attesa sono aggiunte al foglio prenotazioni letto dal target.
+
+    Le righe di un'altra istanza restano invisibili finché quella non le
+    invia: flush() scrive quindi con target.append_prenotazioni_unique, che
+    ricontrolla le chiavi subito prima dell'append (e per Google Sheets
+    riconcilia dopo), e le righe in conflitto vengono scartate: la sessione
+    che le ha inviate le ritrova con queue_outcome() (quelle non reclamate
+    scadono dopo REJECTED_TTL secondi).
+    """
+
+    def __init__(self, target: Repository, journal_path: str, flush_seconds: float = 2.0,
+                 base_backoff: float = 2.0, max_backoff: float = 120.0):
+        super().__init__(target.normalize)
+        self.target = target
+        self.journal_path = journal_path
+        self.flush_seconds = flush_seconds
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.last_flush = 0.0
+        self.last_error: Optional[Exception] = None
+        self.retry_at = 0.0
+        # Righe scartate all'invio (già prenotate da un'altra istanza), con l'ora
+        self._rejected: List[Tuple[float, List[str]]] = []
+        self._attempts = 0
+        self._cond = threading.Condition()
+        self._pending: List[List[str]] = self._read_journal()
+        # Aumenta a ogni modifica della coda: chiave della cache del DataFrame unito
+        self._pending_seq = 0
+        self._merged: Tuple[Optional[tuple], Optional[pd.DataFrame]] = (None, None)
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # --- journal ---
+    def _read_journal(self) -> List[List[str]]:
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, encoding="utf-8") as f:
+            return [json.loads(line)["row"] for line in f if line.strip()]
+
+    def _write_journal(self, rows: List[List[str]], mode: str, path: Optional[str] = None):
+        with open(path or self.journal_path, mode, encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({"row": row}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        # Riscrittura atomica con le sole righe ancora in attesa
+        tmp_path = self.journal_path + ".tmp"
+        self._write_journal(self._pending, "w", path=tmp_path)
+        os.replace(tmp_path, self.journal_path)
+
+    # --- Repository ---
+    def append_prenotazioni(self, rows: List[List[str]]):
+        with self._cond:
+            self._write_journal(rows, "a")
+            self._pending.extend(list(r) for r in rows)
+            self._pending_seq += 1
+            self._cond.notify()
+
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        pending = self.pending_rows()
+        sheets = self.target.read_sheets()
+        header, rows = sheets["prenotazioni"]
+        sheets["prenotazioni"] = (header, rows + _align_rows(header, pending))
+        return sheets
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        # La coda si legge prima del target: se nel frattempo viene svuotata,
+        # le righe compaiono al più due volte, mai zero
+        with self._cond:
+            pending, seq = list(self._pending), self._pending_seq
+        database, prenotazioni, gestori = self.target.load()
+        if not pending:
+            return database, prenotazioni, gestori
+
+        key = (id(prenotazioni), seq)
+        if self._merged[0] != key:
+            header = list(prenotazioni.columns)
+            extra = to_frame(header, _align_rows(header, pending), self.normalize)
+            self._merged = (key, pd.concat([prenotazioni, extra], ignore_index=True))
+        return database, self._merged[1], gestori
+
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        """
+        Le modifiche vanno subito al target (righe già inviate): quelle ancora
+        in coda non hanno una posizione sul foglio e risultano StaleBookingError.
+        """
+        self.target.update_prenotazioni(updates)
+        with self._cond:
+            self._merged = (None, None)
+
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        # Le righe in coda sono nuove prenotazioni: non sono mai da archiviare
+        archived = self.target.archive_prenotazioni(cutoff, limit)
+        with self._cond:
+            self._merged = (None, None)
+        return archived
+
+    def read_archivio(self) -> pd.DataFrame:
+        return self.target.read_archivio()
+
+    def load_portafogli(self, portafogli: Iterable[str]) -> bool:
+        return self.target.load_portafogli(portafogli)
+
+    def write_status(self) -> Optional[WriteStatus]:
+        with self._cond:
+            return WriteStatus(len(self._pending), self.last_flush, self.last_error, self.retry_at)
+
+    def queue_outcome(self, rows: List[List[str]]) -> Tuple[List[List[str]], List[List[str]]]:
+        wanted = {_row_id(row) for row in rows}
+        with self._cond:
+            rejected = [row for _, row in self._rejected if _row_id(row) in wanted]
+            self._rejected = [(at, row) for at, row in self._rejected if _row_id(row) not in wanted]
+            pending = [row for row in self._pending if _row_id(row) in wanted]
+        return rejected, pending
+
+    def prenotazioni_header(self) -> List[str]:
+        return self.target.prenotazioni_header()
+
+    def _pending_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        pending = self.pending_rows()
+        if not pending:
+            return set()
+        return keys & {_new_row_key(row) for row in pending}
+
+    def active_booking_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        """Chiavi già attive nel target o tra le righe ancora in coda."""
+        return self.target.active_booking_conflicts(keys) | self._pending_conflicts(keys)
+
+    def append_prenotazioni_if_absent(self, rows: List[List[str]], keys: Set[BookingKey]):
+        # Il controllo sul target (rete) avviene fuori dal lock; quello sulla coda
+        # e l'accodamento sono atomici rispetto alle altre scritture del processo
+        conflicts = self.target.active_booking_conflicts(keys)
+        with self._cond:
+            conflicts |= self._pending_conflicts(keys)
+            if conflicts:
+                raise DuplicateBookingError(conflicts)
+            self.append_prenotazioni(rows)
+
+    def pending_rows(self) -> List[List[str]]:
+        with self._cond:
+            return list(self._pending)
+
+    # --- worker ---
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Attende flush_seconds per raccogliere altre prenotazioni (o il backoff)
+                wait = max(self.flush_seconds, self.retry_at - time.time())
+            time.sleep(wait)
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        Invia al target tutte le righe in attesa con un'unica scrittura, dopo aver
+        ricontrollato sul target le chiavi: le righe già prenotate nel frattempo
+        (da un'altra istanza) si scartano. True se riuscito.
+        """
+        with self._cond:
+            batch = list(self._pending)
+        if not batch:
+            return True
+
+        try:
+            rejected = self.target.append_prenotazioni_unique(batch)
+        except Exception as e:
+            self._attempts += 1
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (self._attempts - 1))
+            self.retry_at = time.time() + delay * random.uniform(0.5, 1.5)
+            self.last_error = e
+            return False
+
+        with self._cond:
+            self._pending = self._pending[len(batch):]
+            self._pending_seq += 1
+            self._rewrite_journal()
+            self._attempts = 0
+            self.retry_at = 0.0
+            self.last_error = None
+            self.last_flush = time.time()
+            now = time.time()
+            self._rejected = [(at, row) for at, row in self._rejected if now - at < REJECTED_TTL]
+            self._rejected.extend((now, row) for row in rejected)
+        return True
+
+
+class MirroredRepository(Repository):
+    """
+    SQLite come archivio primario (letture e scritture locali) e un secondo
+    Repository come mirror, tipicamente Google Sheets dietro una
+    WriteBehindRepository, così che l'invio sia asincrono:
+
+    - le prenotazioni sono scritte su SQLite e consegnate al mirror;
+    - ogni `pull_seconds` il mirror viene riletto in background e i fogli
+      cambiati (es. modifiche manuali dello staff) sostituiscono le tabelle
+      locali; la WriteBehindRepository include nella lettura le righe non
+      ancora inviate, che quindi non si perdono.
+    """
+
+    def __init__(self, primary: SQLiteRepository, mirror: Repository,
+                 pull_seconds: float = FULL_RELOAD_SECONDS):
+        super().__init__(primary.normalize)
+        self.primary = primary
+        self.mirror = mirror
+        self.pull_seconds = pull_seconds
+        self.last_pull = 0.0
+        self.last_error: Optional[Exception] = None
+        self._checksums: Dict[str, str] = {}
+        self._mirror_lock = threading.Lock()
+
+    def read_sheets(self) -> Dict[str, SheetRows]:
+        return self.primary.read_sheets()
+
+    def load(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        if self.primary.is_empty():
+            self.pull()
+        elif time.time() - self.last_pull > self.pull_seconds:
+            self.last_pull = time.time()
+            threading.Thread(target=self._background_pull, daemon=True).start()
+        return self.primary.load()
+
+    def append_prenotazioni(self, rows: List[List[str]]):
+        with self._mirror_lock:
+            self.primary.append_prenotazioni(rows)
+            self.mirror.append_prenotazioni(rows)
+
+    def prenotazioni_header(self) -> List[str]:
+        return self.primary.prenotazioni_header()
+
+    def active_booking_conflicts(self, keys: Set[BookingKey]) -> Set[BookingKey]:
+        return self.primary.active_booking_conflicts(keys)
+
+    def append_prenotazioni_if_absent(self, rows: List[List[str]], keys: Set[BookingKey]):
+        # Il controllo atomico avviene sul primario; il mirror riceve la riga dopo
+        with self._mirror_lock:
+            self.primary.append_prenotazioni_if_absent(rows, keys)
+            self.mirror.append_prenotazioni(rows)
+
+    def update_prenotazioni(self, updates: List[BookingUpdate]):
+        # Prima il mirror: se il primario fallisse, il prossimo pull lo riallinea
+        with self._mirror_lock:
+            self.mirror.update_prenotazioni(updates)
+            self.primary.update_prenotazioni(updates)
+
+    def archive_prenotazioni(self, cutoff: date, limit: int) -> int:
+        # Stesso criterio sui due lati: il mirror sceglie le stesse righe del primario
+        with self._mirror_lock:
+            archived = self.mirror.archive_prenotazioni(cutoff, limit)
+            self.primary.archive_prenotazioni(cutoff, limit)
+            return archived
+
+    def read_archivio(self) -> pd.DataFrame:
+        # Lo storico completo è sul mirror (il pull non importa l'archivio)
+        return self.mirror.read_archivio()
+
+    def write_status(self) -> Optional[WriteStatus]:
+        return self.mirror.write_status()
+
+    def pull(self):
+        """Importa nel primario i fogli del mirror che risultano cambiati."""
+        with self._mirror_lock:
+            self.last_pull = time.time()
+            for name, (header, rows) in self.mirror.read_sheets().items():
+                checksum = update_digest(hashlib.md5(), [header] + rows).hexdigest()
+                if checksum == self._checksums.get(name):
+                    continue
+                self.primary.replace_sheet(name, header, rows)
+                self._checksums[name] = checksum
+
+    def _background_pull(self):
+        try:
+            self.pull()
+            self.last_error = None
+        except Exception as e:
+            # Si continua a servire il contenuto locale
+            self.last_error = e
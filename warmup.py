@@ -0,0 +1,48 @@
+"""
+Riscaldamento del processo all'avvio.
+
+Le fasi costose del primo caricamento (autenticazione del service account,
+apertura del foglio, download dei fogli, normalizzazione e indici) girano
+in un thread di background: la pagina di login si serve subito e il primo
+utente trova, di norma, lo snapshot già pronto. `ready` segnala la fine del
+riscaldamento, riuscito o no; ogni fase è misurata in metrics.py.
+"""
+
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from metrics import METRICS
+
+
+class WarmUp:
+    """Esegue in ordine le fasi indicate in un thread di background."""
+
+    def __init__(self, steps: List[Tuple[str, Callable[[], object]]]):
+        self.steps = steps
+        self.ready = threading.Event()
+        self.current: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.started_at = time.time()
+        self.finished_at = 0.0
+        METRICS.register_gauges("warmup_ready", "Riscaldamento all'avvio completato (1) o in corso (0).",
+                                "state", lambda: {"ready": float(self.ready.is_set())})
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            for name, step in self.steps:
+                self.current = name
+                with METRICS.time(f"warmup_{name}"):
+                    step()
+        except Exception as e:
+            # Le sessioni rifanno la fase mancante al primo utilizzo
+            self.error = e
+        finally:
+            self.current = None
+            self.finished_at = time.time()
+            self.ready.set()
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at